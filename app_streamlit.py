@@ -1,20 +1,30 @@
 """Streamlit frontend for Bidirectional Multimodal RAG System."""
 import streamlit as st
 import os
+import hashlib
+import uuid
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 from PIL import Image
 
-from rag.loader import load_kb, KBEntry
-from rag.embeddings import EmbeddingStore
-from rag.retriever import retrieve_verses
-from rag.generator import (
-    ask_gemini, build_qa_prompt, build_story_prompt, 
-    build_image_prompt_text, build_enhanced_image_prompt, build_image_to_text_prompt,
-    build_sequential_story_images_prompt, parse_sequential_image_descriptions
+from rag.generator import build_qa_prompt, build_story_prompt
+from pipeline import (
+    CACHE_DIR, QA_CONTEXT_FIELDS, SCENE_COUNT, STORY_CONTEXT_FIELDS, STORY_CONTEXT_NEIGHBORS,
+    AudioCache, CaptionCache, CircuitBreaker, ImageCache, JobScheduler, QueryCache, ResponseCache,
+    SentenceNarrator, Tracer, analyze_image_job, ask_gemini_streaming, backend_limits, credential_fingerprint,
+    expand_with_neighbors, kb_digest, load_resources, model_router, normalize_query, search_verses, start_trace,
+    story_job
 )
-from rag.vision import caption_image
-from rag.image_generator import generate_image_from_prompt, generate_image_from_rag_prompt, generate_sequential_images
-from rag.tts import generate_speech
+
+
+# Opt-in tracing: VERSE2VISION_TRACE=1 records spans per user action,
+# VERSE2VISION_TRACE_FILE additionally appends them as JSON lines
+TRACE_ENABLED = os.getenv("VERSE2VISION_TRACE", "") == "1"
+TRACE_FILE = os.getenv("VERSE2VISION_TRACE_FILE", "")
+
+# How often the UI polls a running background job
+JOB_POLL_INTERVAL = 1.5  # seconds
 
 
 # Page configuration
@@ -27,12 +37,48 @@ st.set_page_config(
 # Initialize session state
 if "kb_entries" not in st.session_state:
     st.session_state.kb_entries = None
-if "embedding_store" not in st.session_state:
-    st.session_state.embedding_store = None
+if "keyword_index" not in st.session_state:
+    st.session_state.keyword_index = None
+if "neighbor_graph" not in st.session_state:
+    st.session_state.neighbor_graph = None
+if "context_packer" not in st.session_state:
+    st.session_state.context_packer = None
+if "kb_hash" not in st.session_state:
+    st.session_state.kb_hash = ""
 if "initialized" not in st.session_state:
     st.session_state.initialized = False
 if "gemini_api_key" not in st.session_state:
     st.session_state.gemini_api_key = ""
+if "user_id" not in st.session_state:
+    st.session_state.user_id = uuid.uuid4().hex
+
+
+@st.cache_resource(show_spinner=False)
+def get_tracer() -> Tracer:
+    """Process-wide span collector."""
+    return Tracer(export_path=TRACE_FILE)
+
+
+@contextmanager
+def trace_action(action: str):
+    """Start a new trace for one user action (when tracing is enabled)."""
+    if not TRACE_ENABLED:
+        yield
+        return
+    with start_trace(action, get_tracer()):
+        yield
+
+
+@st.cache_resource(show_spinner=False)
+def get_resources(kb_path: str, kb_hash: str):
+    """Shared by all sessions; see pipeline.load_resources()."""
+    return load_resources(kb_path, kb_hash)
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_cache(kb_hash: str) -> QueryCache:
+    """Retrieval result cache, one per knowledge base version."""
+    return QueryCache()
 
 
 def initialize_app():
@@ -47,14 +93,17 @@ def initialize_app():
             st.error(f"Knowledge base not found. Expected at: {kb_path}")
             return False
         
-        with st.spinner("Loading knowledge base..."):
-            entries = load_kb(kb_path)
+        with st.spinner("Loading knowledge base and embeddings..."):
+            # Shared across sessions; only rebuilt when kb.json changes
+            kb_hash = kb_digest(kb_path)
+            entries, keyword_index, neighbor_graph, context_packer = get_resources(
+                str(kb_path), kb_hash
+            )
+            st.session_state.kb_hash = kb_hash
             st.session_state.kb_entries = entries
-        
-        with st.spinner("Building embeddings (this may take a minute)..."):
-            embedding_store = EmbeddingStore()
-            embedding_store.build_embeddings(entries)
-            st.session_state.embedding_store = embedding_store
+            st.session_state.keyword_index = keyword_index
+            st.session_state.neighbor_graph = neighbor_graph
+            st.session_state.context_packer = context_packer
         
         st.session_state.initialized = True
         return True
@@ -63,6 +112,85 @@ def initialize_app():
         return False
 
 
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """Process-wide LLM response cache."""
+    return ResponseCache(path=CACHE_DIR / "responses.sqlite3")
+
+
+@st.cache_resource(show_spinner=False)
+def get_plan_stats() -> dict:
+    """Process-wide outcome counters for structured scene planning."""
+    return {"plans": 0, "structured": 0, "repaired": 0, "fallbacks": 0}
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_cache() -> ImageCache:
+    """Process-wide generated image cache."""
+    return ImageCache(CACHE_DIR / "images")
+
+
+@st.cache_resource(show_spinner=False)
+def get_image_breaker() -> CircuitBreaker:
+    """Process-wide circuit breaker for the image service."""
+    return CircuitBreaker()
+
+
+@st.cache_resource(show_spinner=False)
+def get_caption_cache() -> CaptionCache:
+    """Process-wide image caption cache."""
+    return CaptionCache()
+
+
+@st.cache_resource(show_spinner=False)
+def get_audio_cache() -> AudioCache:
+    """Process-wide narration audio cache."""
+    return AudioCache(CACHE_DIR / "audio")
+
+
+def retrieve(query: str, top_k: int):
+    """Retrieve verses for query using this session's knowledge base."""
+    return search_verses(
+        query,
+        top_k,
+        st.session_state.keyword_index,
+        get_query_cache(st.session_state.kb_hash)
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler() -> JobScheduler:
+    """Process-wide background job scheduler."""
+    return JobScheduler()
+
+
+def show_job(param: str, render) -> None:
+    """Render the job named by query parameter param, polling until it finishes.
+    
+    The job id lives in the URL so a page refresh resumes polling instead
+    of starting the generation over.
+    """
+    job_id = st.query_params.get(param)
+    if not job_id:
+        return
+    scheduler = get_scheduler()
+    job = scheduler.get(job_id)
+    if job is None:
+        # Expired, or the server restarted
+        del st.query_params[param]
+        return
+    polling = not job.finished
+    
+    @st.fragment(run_every=JOB_POLL_INTERVAL if polling else None)
+    def poll():
+        render(job, scheduler)
+        if polling and job.finished:
+            # Rerun the whole app once more to stop polling
+            st.rerun()
+    
+    poll()
+
+
 def get_api_key() -> str:
     """Get API key from session state or environment variable."""
     if st.session_state.gemini_api_key:
@@ -109,17 +237,16 @@ with st.sidebar:
     st.header("📖 Verse Explorer")
     
     if st.session_state.kb_entries:
-        verse_options = {
-            f"Verse {entry.verse_number} - {entry.id}": entry
-            for entry in st.session_state.kb_entries
-        }
+        kb_entries = st.session_state.kb_entries
         
-        selected_verse_label = st.selectbox(
+        # Select by index so no per-session label -> entry map is built
+        selected_index = st.selectbox(
             "Select a verse:",
-            options=list(verse_options.keys())
+            options=range(len(kb_entries)),
+            format_func=lambda i: f"Verse {kb_entries[i].verse_number} - {kb_entries[i].id}"
         )
         
-        selected_verse = verse_options[selected_verse_label]
+        selected_verse = kb_entries[selected_index]
         
         st.markdown("### Sanskrit")
         st.text(selected_verse.text_sanskrit)
@@ -144,6 +271,100 @@ with st.sidebar:
         
         with st.expander("😊 Emotions"):
             st.write(", ".join(selected_verse.emotion))
+        
+        with st.expander("🔗 Related Verses"):
+            keyword_index = st.session_state.keyword_index
+            for verse_id, similarity in st.session_state.neighbor_graph.related(selected_verse.id):
+                related = keyword_index.entries[keyword_index.positions[verse_id]]
+                st.write(f"**Verse {related.verse_number}** ({similarity:.2f}): {related.meaning_simple_en}")
+    
+    st.markdown("---")
+    with st.expander("⚙️ Cache Stats"):
+        response_cache = get_response_cache()
+        st.caption(
+            f"LLM responses: {response_cache.hits} hits / {response_cache.misses} misses, "
+            f"{response_cache.evictions} evicted"
+        )
+        
+        image_cache = get_image_cache()
+        st.caption(
+            f"Images: {image_cache.hits} hits / {image_cache.misses} misses, "
+            f"{image_cache.evictions} evicted"
+        )
+        
+        plan_stats = get_plan_stats()
+        if plan_stats["plans"]:
+            st.caption(
+                f"Scene plans: {plan_stats['structured']} parsed cleanly, "
+                f"{plan_stats['repaired']} repaired, {plan_stats['fallbacks']} fell back "
+                f"of {plan_stats['plans']}"
+            )
+        
+        caption_cache = get_caption_cache()
+        st.caption(
+            f"Image captions: {caption_cache.hits} hits / {caption_cache.misses} misses, "
+            f"{caption_cache.bytes_saved / 1024:.0f} KB upload saved"
+        )
+        
+        query_cache = get_query_cache(st.session_state.kb_hash)
+        st.caption(f"Retrieval: {query_cache.hits} hits / {query_cache.misses} misses")
+        
+        packer = st.session_state.context_packer
+        if packer is not None and packer.full_tokens:
+            st.caption(
+                f"Prompt context: {packer.packed_tokens} of {packer.full_tokens} verse tokens sent "
+                f"({packer.packed_tokens / packer.full_tokens:.0%})"
+            )
+        
+        audio_cache = get_audio_cache()
+        st.caption(f"Narration: {audio_cache.hits} hits / {audio_cache.misses} misses")
+        
+        breaker = get_image_breaker()
+        latencies = sorted(breaker.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            st.caption(f"Image service: p50 {p50:.1f}s, p95 {p95:.1f}s over {len(latencies)} calls")
+        if breaker.is_open:
+            st.caption("⚠️ Image service circuit open (failing fast)")
+        
+        for model in model_router.models:
+            model_stats = model_router.stats(model)
+            if model_router.breakers[model].is_open:
+                st.caption(f"⚠️ {model}: skipped after failures")
+            elif model_router.degraded(model):
+                st.caption(f"⚠️ {model}: tried last (p95 {model_stats['p95'] or 0:.1f}s, "
+                           f"{model_stats['error_rate']:.0%} errors)")
+            elif model_stats["p50"] is not None:
+                st.caption(f"{model}: first chunk p50 {model_stats['p50']:.1f}s, p95 {model_stats['p95']:.1f}s")
+        
+        scheduler = get_scheduler()
+        job_stats = scheduler.stats()
+        st.caption(
+            f"Jobs: {job_stats['running']} running, {job_stats['queued']} queued, "
+            f"{scheduler.deduplicated} deduplicated, {scheduler.rejected} rejected"
+        )
+        for name, limiter in backend_limits.items():
+            if limiter.calls:
+                st.caption(f"{name} backend: {limiter.calls} calls, {limiter.waited / limiter.calls:.2f}s avg wait")
+    
+    if TRACE_ENABLED:
+        with st.expander("🩺 Diagnostics"):
+            tracer = get_tracer()
+            recent = list(tracer.spans)[-50:]
+            if recent:
+                st.dataframe(
+                    [
+                        {"trace": span_["trace_id"], "span": span_["name"],
+                         "ms": span_["duration_ms"], "error": span_["error"] or ""}
+                        for span_ in reversed(recent)
+                    ],
+                    use_container_width=True
+                )
+            else:
+                st.caption("No spans recorded yet")
+            st.code(tracer.to_prometheus(), language="text")
+            st.download_button("Download spans (JSON lines)", tracer.to_jsonl(), file_name="spans.jsonl")
 
 
 # Main area - Simplified Tabs
@@ -174,82 +395,63 @@ with tab1:
         if not api_key:
             st.error("⚠️ Please enter your Gemini API key in the sidebar.")
         else:
-            with st.spinner("Creating your story..."):
+            with st.spinner("Creating your story..."), trace_action("create_story"):
                 try:
                     # Retrieve relevant verses
-                    results = retrieve_verses(
-                        text_input,
-                        st.session_state.embedding_store,
-                        top_k=top_k
-                    )
+                    results = retrieve(text_input, top_k=top_k)
                     
                     if results:
-                        # Generate 3 sequential comic-style storytelling images
-                        story_prompt = build_sequential_story_images_prompt(text_input, results)
-                        descriptions_response = ask_gemini(story_prompt, api_key)
-                        
-                        # Parse descriptions with subtitles
-                        image_data = parse_sequential_image_descriptions(descriptions_response)
-                        
-                        # Generate images
-                        generated_story = []
-                        progress_container = st.container()
-                        
-                        with progress_container:
-                            progress_bar = st.progress(0)
-                            status_text = st.empty()
-                            
-                            for i, (visual_desc, subtitle) in enumerate(image_data, 1):
-                                status_text.text(f"🎨 Creating Scene {i}/3...")
-                                
-                                # Enhance prompt with comic style - subtitle will be displayed in UI, not in image
-                                # But we mention it in prompt to guide the visual storytelling
-                                comic_prompt = f"{visual_desc}, Indian comic book illustration style, vibrant colors, expressive characters, child-friendly, educational storytelling art, visual narrative that tells a story, detailed scene"
-                                
-                                try:
-                                    image = generate_image_from_prompt(comic_prompt, method="pollinations")
-                                    if image:
-                                        generated_story.append((i, subtitle, image, visual_desc))
-                                    progress_bar.progress(i / 3)
-                                except Exception as e:
-                                    st.warning(f"Scene {i} generation failed: {e}")
-                        
-                        progress_bar.empty()
-                        status_text.empty()
-                        
-                        # Display story in clean, visual format
-                        if generated_story:
-                            st.markdown("---")
-                            st.markdown("## 📚 Your Story")
-                            
-                            # Generate narration text
-                            narration_parts = [f"Scene {i}: {subtitle}" for i, subtitle, _, _ in generated_story]
-                            full_narration = ". ".join(narration_parts) + "."
-                            
-                            # Create TTS audio (multilingual auto-detect)
-                            audio_data = generate_speech(full_narration)
-                            
-                            # Display audio player if available
-                            if audio_data:
-                                st.audio(audio_data, format="audio/mp3", autoplay=False)
-                                st.caption("🔊 Listen to the story narration (multilingual)")
-                            
-                            # Display images with subtitles
-                            for i, subtitle, image, visual_desc in generated_story:
-                                st.markdown(f"### Scene {i}")
-                                
-                                # Large subtitle display
-                                st.info(f"💬 **{subtitle}**")
-                                
-                                # Image - reduced size
-                                st.image(image, width=600)
-                                
-                                if i < len(generated_story):
-                                    st.markdown("---")
+                        # Generate 3 sequential comic-style storytelling images in the background
+                        job = get_scheduler().submit(
+                            st.session_state.user_id,
+                            # Only share a running job with sessions that would bill the same key
+                            ("story", normalize_query(text_input), top_k, credential_fingerprint(api_key)),
+                            story_job,
+                            text_input, results, api_key, get_response_cache(), get_image_cache(),
+                            get_image_breaker(), get_audio_cache(), get_plan_stats()
+                        )
+                        st.query_params["story_job"] = job.id
                     else:
                         st.warning("No verses found. Try a different topic.")
                 except Exception as e:
                     st.error(f"Error: {e}")
+    
+    def render_story(job, scheduler):
+        """Show the story's scenes as they are planned and illustrated."""
+        scenes = job.progress.get("scenes", [])
+        if job.status == "queued":
+            st.info(f"⏳ Waiting for your earlier request (position {scheduler.position(job)})...")
+        elif job.status == "running":
+            st.progress(job.progress.get("done", 0) / max(len(scenes), SCENE_COUNT))
+            st.text(job.progress.get("status", ""))
+        elif job.error:
+            st.error(f"Error: {job.error}")
+        
+        if scenes:
+            # Display story in clean, visual format
+            st.markdown("---")
+            st.markdown("## 📚 Your Story")
+            
+            # Display audio player if available
+            audio_data = job.result["audio"] if job.result else None
+            if audio_data:
+                st.audio(audio_data, format="audio/mp3", autoplay=False)
+                st.caption("🔊 Listen to the story narration (multilingual)")
+        
+        for i, scene in enumerate(scenes, 1):
+            if i > 1:
+                st.markdown("---")
+            st.markdown(f"### Scene {i}")
+            
+            # Large subtitle display
+            st.info(f"💬 **{scene['subtitle']}**")
+            if scene["image"]:
+                # Image - reduced size
+                st.image(scene["image"], width=600)
+            elif scene["error"]:
+                st.warning(f"Scene {i} generation failed: {scene['error']}")
+    
+    show_job("story_job", render_story)
 
 # Tab 2: Image Analysis
 with tab2:
@@ -266,31 +468,45 @@ with tab2:
             if not api_key:
                 st.error("⚠️ Please enter your Gemini API key in the sidebar.")
             else:
-                with st.spinner("Analyzing..."):
+                with st.spinner("Analyzing..."), trace_action("analyze_image"):
                     try:
-                        image_caption = caption_image(image, api_key)
-                        results = retrieve_verses(
-                            image_caption,
-                            st.session_state.embedding_store,
-                            top_k=5
+                        search = partial(
+                            search_verses,
+                            index=st.session_state.keyword_index,
+                            cache=get_query_cache(st.session_state.kb_hash)
                         )
-                        
-                        if results:
-                            prompt = build_image_to_text_prompt(image_caption, results)
-                            explanation = ask_gemini(prompt, api_key)
-                            
-                            st.markdown("### 📖 Story")
-                            st.write(explanation)
-                            
-                            # Add TTS narration
-                            audio_data = generate_speech(explanation)
-                            if audio_data:
-                                st.audio(audio_data, format="audio/mp3", autoplay=False)
-                                st.caption("🔊 Listen to the explanation")
-                        else:
-                            st.warning("No matching verses found.")
+                        job = get_scheduler().submit(
+                            st.session_state.user_id,
+                            ("analyze", hashlib.sha256(uploaded_file.getvalue()).hexdigest(),
+                             credential_fingerprint(api_key)),
+                            analyze_image_job,
+                            image.copy(), uploaded_file.size, api_key, search, st.session_state.context_packer,
+                            get_caption_cache(), get_response_cache(), get_audio_cache()
+                        )
+                        st.query_params["image_job"] = job.id
                     except Exception as e:
                         st.error(f"Error: {e}")
+    
+    def render_explanation(job, scheduler):
+        """Show the image explanation once it is ready."""
+        if job.status == "queued":
+            st.info(f"⏳ Waiting for your earlier request (position {scheduler.position(job)})...")
+        elif job.status == "running":
+            st.info(job.progress.get("status", "Analyzing..."))
+        elif job.error:
+            st.error(f"Error: {job.error}")
+        elif not job.result["explanation"]:
+            st.warning("No matching verses found.")
+        else:
+            st.markdown("### 📖 Story")
+            st.write(job.result["explanation"])
+            
+            # Add TTS narration
+            if job.result["audio"]:
+                st.audio(job.result["audio"], format="audio/mp3", autoplay=False)
+                st.caption("🔊 Listen to the explanation")
+    
+    show_job("image_job", render_explanation)
 
 # Tab 3: Ask Questions
 with tab3:
@@ -303,23 +519,28 @@ with tab3:
         if not api_key:
             st.error("⚠️ Please enter your Gemini API key in the sidebar.")
         else:
-            with st.spinner("Finding answer..."):
+            with st.spinner("Finding answer..."), trace_action("ask_question"):
                 try:
-                    results = retrieve_verses(
-                        query,
-                        st.session_state.embedding_store,
-                        top_k=5
-                    )
+                    results = retrieve(query, top_k=5)
                     
                     if results:
-                        prompt = build_qa_prompt(query, results)
-                        answer = ask_gemini(prompt, api_key)
+                        prompt = build_qa_prompt(
+                            query, st.session_state.context_packer.pack(results, QA_CONTEXT_FIELDS)
+                        )
                         
                         st.markdown("### 💡 Answer")
-                        st.write(answer)
+                        answer_slot = st.empty()
+                        
+                        # Render the answer as it streams; narrate finished sentences meanwhile
+                        narrator = SentenceNarrator(cache=get_audio_cache())
+                        answer = ""
+                        for chunk in ask_gemini_streaming(prompt, api_key, cache=get_response_cache()):
+                            answer += chunk
+                            answer_slot.markdown(answer)
+                            narrator.feed(answer)
                         
                         # Add TTS narration
-                        audio_data = generate_speech(answer)
+                        audio_data = narrator.finish(answer)
                         if audio_data:
                             st.audio(audio_data, format="audio/mp3", autoplay=False)
                             st.caption("🔊 Listen to the answer")
@@ -339,23 +560,35 @@ with tab4:
         if not api_key:
             st.error("⚠️ Please enter your Gemini API key in the sidebar.")
         else:
-            with st.spinner("Creating story..."):
+            with st.spinner("Creating story..."), trace_action("text_story"):
                 try:
-                    results = retrieve_verses(
-                        story_query,
-                        st.session_state.embedding_store,
-                        top_k=3
-                    )
+                    results = retrieve(story_query, top_k=3)
                     
                     if results:
-                        prompt = build_story_prompt(results)
-                        story = ask_gemini(prompt, api_key)
+                        # Add closely related verses as extra story context
+                        results = expand_with_neighbors(
+                            results,
+                            st.session_state.neighbor_graph,
+                            st.session_state.keyword_index,
+                            limit=len(results) + STORY_CONTEXT_NEIGHBORS
+                        )
+                        prompt = build_story_prompt(
+                            st.session_state.context_packer.pack(results, STORY_CONTEXT_FIELDS)
+                        )
                         
                         st.markdown("### 📚 Story")
-                        st.write(story)
+                        story_slot = st.empty()
+                        
+                        # Render the story as it streams; narrate finished sentences meanwhile
+                        narrator = SentenceNarrator(cache=get_audio_cache())
+                        story = ""
+                        for chunk in ask_gemini_streaming(prompt, api_key, cache=get_response_cache()):
+                            story += chunk
+                            story_slot.markdown(story)
+                            narrator.feed(story)
                         
                         # Add TTS for text story (multilingual auto-detect)
-                        audio_data = generate_speech(story)
+                        audio_data = narrator.finish(story)
                         if audio_data:
                             st.audio(audio_data, format="audio/mp3", autoplay=False)
                             st.caption("🔊 Listen to the story (multilingual)")
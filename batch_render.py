@@ -0,0 +1,246 @@
+"""Headless batch rendering of visual stories (retrieve -> plan -> images -> narration).
+
+Examples:
+    python batch_render.py --all-verses --out renders
+    python batch_render.py --verses hc_001 hc_023 --out renders
+    python batch_render.py --topics-file topics.txt --workers 4 --image-concurrency 3
+    python batch_render.py --all-verses --offline --out /tmp/renders   # stub backends, no network
+
+Progress is checkpointed in <out>/manifest.jsonl; re-running the same command
+skips items that already rendered successfully.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pipeline
+from pipeline import BACKEND_LIMITS, BackendLimiter, CircuitBreaker, kb_digest, load_resources, retrieve_batch, story_job
+from offline import offline_image, offline_llm, offline_speech, offline_stream
+from rag.image_generator import generate_image_from_prompt
+from rag.tts import generate_speech
+
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+BACKENDS = {
+    "live": {"stream": pipeline.stream_gemini, "ask": pipeline.ask_gemini_serialized,
+             "generate": generate_image_from_prompt, "synthesize": generate_speech},
+    "offline": {"stream": offline_stream, "ask": offline_llm, "generate": offline_image,
+                "synthesize": offline_speech},
+}
+
+
+# ---------------------------------------------------------------------------
+# Worker process state
+# ---------------------------------------------------------------------------
+
+_worker = {}
+
+
+def init_worker(entries_by_id: dict, backend: str, api_key: str, slots: dict):
+    """Set up per-process state: the KB entries, backends and service limits."""
+    # Concurrency limits are shared by every worker process; stub backends need no rate limit
+    for name, (concurrency, rate) in BACKEND_LIMITS.items():
+        pipeline.backend_limits[name] = BackendLimiter(
+            concurrency, rate if backend == "live" else float("inf"), slots=slots[name]
+        )
+    _worker.update(
+        entries=entries_by_id,
+        backend=BACKENDS[backend],
+        api_key=api_key,
+        breaker=CircuitBreaker(),
+        plan_stats={"plans": 0, "structured": 0, "repaired": 0, "fallbacks": 0},
+    )
+
+
+def render_item(item: dict, out_dir: str) -> dict:
+    """Render one story into out_dir/assets/<id>/ and return its manifest record.
+    
+    Raises if any scene image or the narration is missing, so the item is
+    recorded as failed and a resumed run renders it again.
+    """
+    start = time.perf_counter()
+    item_dir = Path(out_dir) / "assets" / item["id"]
+    tmp_dir = item_dir.with_name(item["id"] + ".partial")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    
+    # Verses were retrieved for every item up front by the parent
+    results = [(_worker["entries"][verse_id], score) for verse_id, score in item["verses"]]
+    if not results:
+        raise ValueError("no verses retrieved")
+    
+    # Plan, illustrate and narrate, exactly as the app does
+    story = story_job(
+        {}, item["query"], results, _worker["api_key"], None, None, _worker["breaker"], None,
+        _worker["plan_stats"], **_worker["backend"]
+    )
+    if not story["scenes"]:
+        raise ValueError("scene plan could not be parsed")
+    failed = [f"scene {i}: {scene['error']}" for i, scene in enumerate(story["scenes"], 1) if not scene["image"]]
+    if failed:
+        raise RuntimeError("; ".join(failed))
+    if not story["audio"]:
+        raise RuntimeError("narration failed")
+    
+    scene_records = []
+    for i, scene in enumerate(story["scenes"], 1):
+        scene["image"].convert("RGB").save(tmp_dir / f"scene_{i}.jpg", format="JPEG", quality=90)
+        scene_records.append({
+            "scene": i,
+            "subtitle": scene["subtitle"],
+            "visual": scene["visual"],
+            "image": f"assets/{item['id']}/scene_{i}.jpg",
+        })
+    (tmp_dir / "narration.mp3").write_bytes(story["audio"])
+    
+    # Publish the item's assets atomically
+    shutil.rmtree(item_dir, ignore_errors=True)
+    tmp_dir.replace(item_dir)
+    
+    return {
+        "id": item["id"],
+        "query": item["query"],
+        "verses": [entry.id for entry, _ in results],
+        "scenes": scene_records,
+        "narration": f"assets/{item['id']}/narration.mp3",
+        "status": "ok",
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def load_completed(manifest_path: Path) -> set:
+    """Return the ids of items already rendered successfully."""
+    completed = set()
+    if not manifest_path.exists():
+        return completed
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Truncated last line from an interrupted run
+            if record.get("status") == "ok":
+                completed.add(record["id"])
+    return completed
+
+
+def build_items(args, entries) -> list:
+    """Turn CLI arguments into render items with stable ids."""
+    entries_by_id = {entry.id: entry for entry in entries}
+    items = []
+    verse_ids = list(entries_by_id) if args.all_verses else (args.verses or [])
+    for verse_id in verse_ids:
+        if verse_id not in entries_by_id:
+            print(f"⚠️  Unknown verse id: {verse_id}")
+            continue
+        entry = entries_by_id[verse_id]
+        items.append({"id": verse_id, "verse_id": verse_id, "query": entry.story_seed_en or entry.meaning_simple_en})
+    
+    topics = list(args.topics or [])
+    if args.topics_file:
+        with open(args.topics_file, "r", encoding="utf-8") as f:
+            topics.extend(line.strip() for line in f if line.strip())
+    for topic in topics:
+        topic_id = "topic-" + hashlib.sha1(topic.encode("utf-8")).hexdigest()[:10]
+        items.append({"id": topic_id, "query": topic})
+    return items
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Pre-render visual stories for topics or verses.")
+    parser.add_argument("--kb", default="kb.json", help="Knowledge base path")
+    parser.add_argument("--out", default="renders", help="Output directory for manifest and assets")
+    parser.add_argument("--topics", nargs="*", help="Story topics")
+    parser.add_argument("--topics-file", help="File with one topic per line")
+    parser.add_argument("--verses", nargs="*", help="Verse ids from the knowledge base")
+    parser.add_argument("--all-verses", action="store_true", help="Render every verse in the knowledge base")
+    parser.add_argument("--top-k", type=int, default=3, help="Verses retrieved per topic")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Worker processes")
+    parser.add_argument("--llm-concurrency", type=int, default=2, help="Max concurrent LLM calls")
+    parser.add_argument("--image-concurrency", type=int, default=3, help="Max concurrent image requests")
+    parser.add_argument("--tts-concurrency", type=int, default=2, help="Max concurrent TTS calls")
+    parser.add_argument("--offline", action="store_true", help="Use local stub backends (no network)")
+    parser.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY", ""), help="Gemini API key")
+    args = parser.parse_args(argv)
+    
+    if not args.offline and not args.api_key:
+        print("❌ GEMINI_API_KEY not set (or pass --api-key, or use --offline)")
+        return 1
+    
+    # Fitted once in the parent (or loaded from the app's .cache)
+    entries, keyword_index, _, _ = load_resources(args.kb, kb_digest(Path(args.kb)))
+    items = build_items(args, entries)
+    if not items:
+        print("❌ Nothing to render: pass --topics, --topics-file, --verses or --all-verses")
+        return 1
+    
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / MANIFEST_NAME
+    completed = load_completed(manifest_path)
+    pending = [item for item in items if item["id"] not in completed]
+    print(f"📋 {len(items)} items, {len(items) - len(pending)} already rendered, {len(pending)} to go")
+    if not pending:
+        return 0
+    
+    # Retrieve for every topic in one batch; workers only need the entries
+    topics = [item for item in pending if not item.get("verse_id")]
+    for item, results in zip(topics, retrieve_batch([item["query"] for item in topics], keyword_index, args.top_k)):
+        item["verses"] = [(entry.id, score) for entry, score in results]
+    for item in pending:
+        if item.get("verse_id"):
+            item["verses"] = [(item["verse_id"], 1.0)]
+    
+    # Service limits are shared by every worker process
+    context = multiprocessing.get_context()
+    slots = {
+        "llm": context.BoundedSemaphore(args.llm_concurrency),
+        "image": context.BoundedSemaphore(args.image_concurrency),
+        "tts": context.BoundedSemaphore(args.tts_concurrency),
+    }
+    
+    failures = 0
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(args.workers, len(pending))),
+        mp_context=context,
+        initializer=init_worker,
+        initargs=({entry.id: entry for entry in entries}, "offline" if args.offline else "live", args.api_key, slots),
+    ) as executor, open(manifest_path, "a", encoding="utf-8") as manifest:
+        futures = {executor.submit(render_item, item, str(out_dir)): item for item in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                record = future.result()
+                print(f"✅ [{done}/{len(pending)}] {item['id']} ({record['seconds']:.1f}s)")
+            except Exception as e:
+                failures += 1
+                record = {"id": item["id"], "query": item["query"], "status": "error", "error": str(e)}
+                print(f"❌ [{done}/{len(pending)}] {item['id']}: {e}")
+            # Checkpoint after every item so an interrupted run can resume
+            manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+    
+    print(f"\n📦 Manifest: {manifest_path} ({failures} failed)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,594 @@
+"""Offline benchmarks for the retrieval and generation pipeline (no network, no API key).
+
+Examples:
+    python benchmark.py flows --iterations 20 --llm-latency 0.2 --image-latency 0.4
+    python benchmark.py flows --save-baseline bench_baseline.json
+    python benchmark.py flows --baseline bench_baseline.json --tolerance 0.25
+    python benchmark.py retrieval
+    python benchmark.py scheduler --sessions 40 --topics 15
+    python benchmark.py context --top-k 5
+    python benchmark.py startup --iterations 5
+    python benchmark.py tracing --spans 200000
+    python benchmark.py ttfb --llm-latency 0.5 --chunk-latency 0.03
+
+Every backend is a deterministic stand-in from offline.py; the --*-latency
+options add a fixed service time per call. `flows` runs the app's four
+flows (create story, analyze image, ask question, text story) and exits
+non-zero when a run regresses against a saved baseline.
+"""
+import argparse
+import hashlib
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+
+from PIL import Image
+
+import offline
+import pipeline
+from offline import offline_caption, offline_image, offline_llm, offline_speech, offline_stream
+from pipeline import (
+    BACKEND_LIMITS, IMAGE_CONTEXT_FIELDS, QA_CONTEXT_FIELDS, STORY_CONTEXT_FIELDS, STORY_CONTEXT_NEIGHBORS,
+    BackendLimiter, JobScheduler, ModelRouter, QueryCache, SentenceNarrator, Tracer, analyze_image_job,
+    ask_gemini_cached, ask_gemini_streaming, backend_limits, estimate_tokens, expand_with_neighbors,
+    hybrid_retrieve, kb_digest, load_resources, retrieve_batch, search_verses, span, start_trace, story_job
+)
+from rag.embeddings import EmbeddingStore
+from rag.generator import build_image_to_text_prompt, build_qa_prompt, build_story_prompt
+from rag.retriever import retrieve_verses
+
+
+BACKENDS = {"stream": offline_stream, "ask": offline_llm, "generate": offline_image, "synthesize": offline_speech}
+
+# Compared against the baseline; lower is better for all of them
+BASELINE_METRICS = ("wall_p50_ms", "cpu_ms", "peak_kb")
+# Differences below these are noise, whatever the relative change
+BASELINE_SLACK = {"wall_p50_ms": 2.0, "cpu_ms": 2.0, "peak_kb": 64.0}
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def load_kb_resources(kb_path: str) -> dict:
+    entries, index, graph, packer = load_resources(kb_path, kb_digest(Path(kb_path)))
+    return {"entries": entries, "index": index, "graph": graph, "packer": packer}
+
+
+def keyword_queries(entries) -> list:
+    """One short query per verse, made of its first two keywords."""
+    return [" ".join(entry.keywords[:2]) for entry in entries if entry.keywords]
+
+
+# ---------------------------------------------------------------------------
+# End-to-end flows
+# ---------------------------------------------------------------------------
+
+def stream_and_narrate(prompt: str) -> str:
+    """Stream an answer and narrate it sentence by sentence, as tabs 3 and 4 do."""
+    narrator = SentenceNarrator(synthesize=offline_speech)
+    text = ""
+    for chunk in ask_gemini_streaming(prompt, "", stream=offline_stream, ask=offline_llm):
+        text += chunk
+        narrator.feed(text)
+    narrator.finish(text)
+    return text
+
+
+def flow_create_story(kb: dict, query: str) -> None:
+    results = search_verses(query, 3, kb["index"], QueryCache())
+    plan_stats = {"plans": 0, "structured": 0, "repaired": 0, "fallbacks": 0}
+    story_job({}, query, results, "", None, None, None, None, plan_stats, **BACKENDS)
+
+
+def flow_analyze_image(kb: dict, query: str) -> None:
+    image = Image.new("RGB", (1600, 1200), tuple(hashlib.sha256(query.encode("utf-8")).digest()[:3]))
+    search = partial(search_verses, index=kb["index"], cache=QueryCache())
+    analyze_image_job(
+        {}, image, 2 * 1024 * 1024, "", search, kb["packer"], None, None, None,
+        captioner=offline_caption, ask=offline_llm, synthesize=offline_speech
+    )
+
+
+def flow_ask_question(kb: dict, query: str) -> None:
+    results = search_verses(query, 5, kb["index"], QueryCache())
+    with span("build_prompt"):
+        prompt = build_qa_prompt(query, kb["packer"].pack(results, QA_CONTEXT_FIELDS))
+    stream_and_narrate(prompt)
+
+
+def flow_text_story(kb: dict, query: str) -> None:
+    results = search_verses(query, 3, kb["index"], QueryCache())
+    with span("build_prompt"):
+        results = expand_with_neighbors(results, kb["graph"], kb["index"], limit=len(results) + STORY_CONTEXT_NEIGHBORS)
+        prompt = build_story_prompt(kb["packer"].pack(results, STORY_CONTEXT_FIELDS))
+    stream_and_narrate(prompt)
+
+
+FLOWS = {
+    "create_story": flow_create_story,
+    "analyze_image": flow_analyze_image,
+    "ask_question": flow_ask_question,
+    "text_story": flow_text_story,
+}
+
+
+def measure_flow(name: str, kb: dict, queries: list, iterations: int) -> dict:
+    """Run one flow repeatedly and return its wall, CPU, allocation and per-stage numbers."""
+    flow = FLOWS[name]
+    flow(kb, queries[0])  # Warm up lazy imports and per-entry caches
+    
+    tracer = Tracer(max_spans=100000)
+    walls = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for i in range(iterations):
+        flow_start = time.perf_counter()
+        with start_trace(name, tracer):
+            flow(kb, queries[i % len(queries)])
+        walls.append(time.perf_counter() - flow_start)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    
+    # Allocations are measured on a separate run so tracing does not skew the timings
+    tracemalloc.start()
+    flow(kb, queries[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    stages = {}
+    for record in tracer.spans:
+        if record["name"] != name:
+            stages.setdefault(record["name"], []).append(record["duration_ms"])
+    return {
+        "iterations": iterations,
+        "wall_p50_ms": round(1000 * statistics.median(walls), 3),
+        "wall_p95_ms": round(1000 * percentile(walls, 0.95), 3),
+        "cpu_ms": round(1000 * cpu / iterations, 3),
+        "peak_kb": round(peak / 1024, 1),
+        "throughput_per_s": round(iterations / elapsed, 2),
+        "stages": {
+            stage: {"calls": round(len(durations) / iterations, 2), "p50_ms": round(statistics.median(durations), 3)}
+            for stage, durations in sorted(stages.items())
+        },
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """Return a description of every metric that is worse than baseline by more than tolerance."""
+    regressions = []
+    for name, flow in baseline.get("flows", {}).items():
+        current = report["flows"].get(name)
+        if current is None:
+            continue
+        for metric in BASELINE_METRICS:
+            limit = flow[metric] * (1 + tolerance) + BASELINE_SLACK[metric]
+            if current[metric] > limit:
+                regressions.append(f"{name} {metric}: {current[metric]:g} > {flow[metric]:g} (+{tolerance:.0%})")
+    return regressions
+
+
+def run_flows(args) -> int:
+    if not args.rate_limits:
+        # Measure the pipeline, not the spacing between calls; concurrency caps stay
+        for name, (concurrency, _) in BACKEND_LIMITS.items():
+            backend_limits[name] = BackendLimiter(concurrency, float("inf"))
+    kb = load_kb_resources(args.kb)
+    queries = keyword_queries(kb["entries"])
+    report = {"latency": dict(offline.LATENCY), "rate_limits": args.rate_limits, "flows": {}}
+    for name in args.flow or FLOWS:
+        result = report["flows"][name] = measure_flow(name, kb, queries, args.iterations)
+        print(f"\n{name}: p50 {result['wall_p50_ms']:.1f} ms, p95 {result['wall_p95_ms']:.1f} ms, "
+              f"CPU {result['cpu_ms']:.1f} ms, peak {result['peak_kb']:.0f} KB, {result['throughput_per_s']:.1f}/s")
+        for stage, numbers in result["stages"].items():
+            print(f"    {stage:28} {numbers['calls']:5.1f} calls  p50 {numbers['p50_ms']:8.2f} ms")
+    
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if (baseline.get("latency"), baseline.get("rate_limits")) != (report["latency"], report["rate_limits"]):
+            print("⚠️  Baseline was recorded with different backend latencies or rate limits")
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"\n✅ No regressions against {args.baseline}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Retrieval quality and latency
+# ---------------------------------------------------------------------------
+
+# Hand-labelled (query, relevant verse ids): paraphrases that avoid the verses' own keyword and tag strings
+RELEVANCE_SET = [
+    ("Sanjeevani", {"hc_013"}),
+    ("who carried the mountain of medicine to bring Lakshmana back to life", {"hc_013"}),
+    ("as a child he tried to eat the sun mistaking it for fruit", {"hc_020"}),
+    ("jumping over the sea to Lanka with the Lord's signet ring in his mouth", {"hc_021"}),
+    ("setting the demon city on fire", {"hc_011"}),
+    ("appearing before Sita in a very small form", {"hc_011"}),
+    ("helping the exiled monkey king win back his throne", {"hc_018"}),
+    ("Ravana's brother took his advice and was crowned", {"hc_019"}),
+    ("keeping ghosts and evil spirits away", {"hc_026"}),
+    ("chanting his name to cure illness and pain", {"hc_027", "hc_038"}),
+    ("nothing to be afraid of for those who take shelter in him", {"hc_024"}),
+    ("golden skin, earrings and curly hair", {"hc_006"}),
+    ("holding a mace and a flag, with the sacred thread on his shoulder", {"hc_007"}),
+    ("born of Kesari as a form of Shiva", {"hc_008"}),
+    ("eight siddhis and nine nidhis granted by Janaki", {"hc_033"}),
+    ("what happens after death to a devotee", {"hc_036"}),
+    ("reading the prayer one hundred times frees you", {"hc_040"}),
+    ("Rama says he is as dear as Bharata", {"hc_014"}),
+    ("Yama and Kubera cannot describe his greatness", {"hc_017"}),
+    ("Brahma, Narada and Saraswati sing of him", {"hc_016"}),
+    ("nobody enters Rama's door without his permission", {"hc_023"}),
+    ("impossible tasks become easy by his grace", {"hc_022"}),
+    ("getting what your heart desires", {"hc_030"}),
+    ("wiping the mirror of the mind with the dust of the teacher's feet", {"hc_001"}),
+    ("I am ignorant, give me strength and understanding", {"hc_002"}),
+    ("taking a huge form to kill the demons", {"hc_012", "hc_032"}),
+    ("the poet's closing request to live in my heart", {"hc_042"}),
+    ("famous in all four ages", {"hc_031"}),
+    ("no need to worship any other god", {"hc_037"}),
+    ("loves to hear the Lord's stories, Rama and Sita live in his heart", {"hc_010"}),
+]
+
+
+def run_retrieval(args) -> int:
+    kb = load_kb_resources(args.kb)
+    # The plain TF-IDF store from rag.embeddings is the baseline
+    store = EmbeddingStore()
+    store.build_embeddings(kb["entries"])
+    known = {entry.id for entry in kb["entries"]}
+    cases = [(query, relevant & known) for query, relevant in RELEVANCE_SET if relevant & known]
+    retrievers = {
+        "tfidf": lambda query: retrieve_verses(query, store, top_k=args.top_k),
+        "hybrid": lambda query: hybrid_retrieve(query, kb["index"], top_k=args.top_k),
+    }
+    print(f"{len(cases)} hand-labelled queries, top_k={args.top_k}")
+    for name, retrieve in retrievers.items():
+        recalls, reciprocal_ranks, latencies = [], [], []
+        for query, relevant in cases:
+            start = time.perf_counter()
+            ranked = [entry.id for entry, score in retrieve(query) if score > 0]
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len(relevant.intersection(ranked)) / min(len(relevant), args.top_k))
+            first = next((rank for rank, verse_id in enumerate(ranked, 1) if verse_id in relevant), None)
+            reciprocal_ranks.append(1 / first if first else 0.0)
+        print(f"{name:7} recall@{args.top_k} {statistics.mean(recalls):.3f}  MRR {statistics.mean(reciprocal_ranks):.3f}  "
+              f"p50 {1000 * statistics.median(latencies):.2f} ms  p95 {1000 * percentile(latencies, 0.95):.2f} ms")
+    
+    # Batch rendering scores every topic at once
+    queries = [query for query, _ in cases]
+    start = time.perf_counter()
+    retrieve_batch(queries, kb["index"], top_k=args.top_k)
+    elapsed = time.perf_counter() - start
+    print(f"hybrid batch of {len(queries)}: {1000 * elapsed:.2f} ms ({1000 * elapsed / len(queries):.3f} ms per query)")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Background job scheduler under concurrent sessions
+# ---------------------------------------------------------------------------
+
+class ConcurrencyProbe:
+    """Counts calls and the peak number of simultaneous calls per backend."""
+    
+    def __init__(self):
+        self.calls = {name: 0 for name in BACKEND_LIMITS}
+        self.peak = {name: 0 for name in BACKEND_LIMITS}
+        self._active = {name: 0 for name in BACKEND_LIMITS}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def track(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+            self._active[name] += 1
+            self.peak[name] = max(self.peak[name], self._active[name])
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[name] -= 1
+
+
+def run_scheduler(args) -> int:
+    kb = load_kb_resources(args.kb)
+    topics = keyword_queries(kb["entries"])[:args.topics]
+    probe = ConcurrencyProbe()
+    
+    def stream(prompt, api_key):
+        # stream_gemini() takes the LLM slot itself; the stand-in has to do the same
+        with backend_limits["llm"], probe.track("llm"):
+            yield from offline_stream(prompt, api_key)
+    
+    def ask(prompt, api_key):
+        with probe.track("llm"):
+            return offline_llm(prompt, api_key)
+    
+    def generate(prompt, method="pollinations"):
+        with probe.track("image"):
+            return offline_image(prompt, method)
+    
+    def synthesize(text):
+        with probe.track("tts"):
+            return offline_speech(text)
+    
+    scheduler = JobScheduler()
+    query_cache = QueryCache()
+    plan_stats = {"plans": 0, "structured": 0, "repaired": 0, "fallbacks": 0}
+    errors = []
+    
+    def session(number: int):
+        """One simulated user: retrieve inline, submit the story job, then poll like the UI."""
+        topic = topics[number % len(topics)]
+        start = time.perf_counter()
+        results = search_verses(topic, 3, kb["index"], query_cache)
+        job = scheduler.submit(
+            f"user-{number}", ("story", topic, 3), story_job,
+            topic, results, "", None, None, None, None, plan_stats,
+            stream, ask, generate, synthesize
+        )
+        blocked = time.perf_counter() - start
+        while not job.finished:
+            time.sleep(args.poll_interval)
+        if job.error:
+            errors.append(job.error)
+        return blocked, time.perf_counter() - start
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        timings = list(executor.map(session, range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    blocked = [timing[0] for timing in timings]
+    latencies = [timing[1] for timing in timings]
+    
+    print(f"{args.sessions} sessions over {len(topics)} topics in {elapsed:.2f}s")
+    print(f"job latency p50 {statistics.median(latencies):.2f}s  p95 {percentile(latencies, 0.95):.2f}s")
+    print(f"session thread blocked at most {1000 * max(blocked):.1f} ms (retrieval + submit)")
+    print(f"jobs submitted {scheduler.submitted}, deduplicated {scheduler.deduplicated}, "
+          f"rejected {scheduler.rejected}, failed {len(errors)}")
+    over_limit = []
+    for name, (concurrency, _) in BACKEND_LIMITS.items():
+        print(f"{name:6} {probe.calls[name]:4} calls, peak concurrency {probe.peak[name]} (limit {concurrency}), "
+              f"{backend_limits[name].waited / max(backend_limits[name].calls, 1):.3f}s avg wait")
+        if probe.peak[name] > concurrency:
+            over_limit.append(name)
+    for error in errors[:3]:
+        print(f"❌ {error}")
+    return 1 if errors or over_limit else 0
+
+
+# ---------------------------------------------------------------------------
+# Prompt context packing
+# ---------------------------------------------------------------------------
+
+def run_context(args) -> int:
+    kb = load_kb_resources(args.kb)
+    packer = kb["packer"]
+    prompt_types = {
+        "qa": (QA_CONTEXT_FIELDS, lambda query, results: build_qa_prompt(query, results)),
+        "story": (STORY_CONTEXT_FIELDS, lambda query, results: build_story_prompt(results)),
+        "image": (IMAGE_CONTEXT_FIELDS, lambda query, results: build_image_to_text_prompt(query, results)),
+    }
+    queries = keyword_queries(kb["entries"])
+    print(f"{len(queries)} queries, top_k={args.top_k}")
+    for name, (weights, build) in prompt_types.items():
+        full, packed, kept, intact, pack_times = [], [], [], [], []
+        top_fields = list(weights)[:2]
+        for query in queries:
+            results = hybrid_retrieve(query, kb["index"], top_k=args.top_k)
+            if not results:
+                continue
+            start = time.perf_counter()
+            packed_results = packer.pack(results, weights)
+            pack_times.append(time.perf_counter() - start)
+            full.append(estimate_tokens(build(query, results)))
+            packed.append(estimate_tokens(build(query, packed_results)))
+            kept.append(len(packed_results) / len(results))
+            # Grounding: the best verse keeps its two most important fields whole
+            top_entry = results[0][0]
+            packed_top = next((entry for entry, _ in packed_results if entry.id == top_entry.id), None)
+            intact.append(packed_top is not None and all(
+                getattr(packed_top, field) == getattr(top_entry, field) for field in top_fields
+            ))
+        print(f"{name:6} prompt tokens {statistics.mean(full):.0f} -> {statistics.mean(packed):.0f} "
+              f"({1 - statistics.mean(packed) / statistics.mean(full):.0%} smaller), "
+              f"verses kept {statistics.mean(kept):.0%}, top verse intact {statistics.mean(intact):.0%}, "
+              f"pack {1e6 * statistics.mean(pack_times):.0f} us")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Cold vs warm startup
+# ---------------------------------------------------------------------------
+
+def run_startup(args) -> int:
+    kb_hash = kb_digest(Path(args.kb))
+    cold, warm = [], []
+    cache_dir = pipeline.CACHE_DIR
+    try:
+        for _ in range(args.iterations):
+            with tempfile.TemporaryDirectory() as directory:
+                pipeline.CACHE_DIR = Path(directory)
+                # First load fits and writes the caches; the second is a restart that reads them
+                for timings in (cold, warm):
+                    start = time.perf_counter()
+                    load_resources(args.kb, kb_hash)
+                    timings.append(time.perf_counter() - start)
+                files = sorted(path.name for path in pipeline.CACHE_DIR.iterdir())
+    finally:
+        pipeline.CACHE_DIR = cache_dir
+    print(f"load_resources() over {args.iterations} runs, cache files: {', '.join(files)}")
+    for name, timings in (("cold", cold), ("warm", warm)):
+        print(f"{name:5} p50 {1000 * statistics.median(timings):.1f} ms  max {1000 * max(timings):.1f} ms")
+    print(f"warm start is {statistics.median(cold) / statistics.median(warm):.1f}x faster")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Tracing overhead
+# ---------------------------------------------------------------------------
+
+def time_blocks(block, count: int, repeats: int) -> float:
+    """Return the best per-iteration time in ns of running block() count times."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            block()
+        best = min(best, (time.perf_counter_ns() - start) / count)
+    return best
+
+
+def run_tracing(args) -> int:
+    def bare():
+        pass
+    
+    def traced():
+        with span("benchmark"):
+            pass
+    
+    results = {"bare block": time_blocks(bare, args.spans, args.repeats)}
+    results["span, tracing off"] = time_blocks(traced, args.spans, args.repeats)
+    # Keep every span so the deque never has to drop (the app keeps the last 1000)
+    tracer = Tracer(max_spans=args.spans)
+    with start_trace("benchmark_trace", tracer):
+        results["span, tracing on"] = time_blocks(traced, args.spans, args.repeats)
+    if args.export:
+        with tempfile.TemporaryDirectory() as directory:
+            tracer = Tracer(export_path=str(Path(directory) / "trace.jsonl"), max_spans=1000)
+            with start_trace("benchmark_trace", tracer):
+                results["span, tracing on + export"] = time_blocks(traced, max(1, args.spans // 100), args.repeats)
+    
+    print(f"{args.spans} blocks, best of {args.repeats}")
+    for name, ns in results.items():
+        print(f"{name:28} {ns:9.1f} ns/block  (+{ns - results['bare block']:.1f} ns)")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Time to first chunk: streamed vs blocking answers
+# ---------------------------------------------------------------------------
+
+def time_answer(answer) -> tuple:
+    """Return (seconds to the first chunk, seconds to the whole answer) for an iterable of chunks."""
+    start = time.perf_counter()
+    first = None
+    for _ in answer:
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def run_ttfb(args) -> int:
+    for name, (concurrency, _) in BACKEND_LIMITS.items():
+        backend_limits[name] = BackendLimiter(concurrency, float("inf"))
+    kb = load_kb_resources(args.kb)
+    prompts = []
+    for query in keyword_queries(kb["entries"])[:args.questions]:
+        results = search_verses(query, 5, kb["index"], QueryCache())
+        prompts.append(build_qa_prompt(query, kb["packer"].pack(results, QA_CONTEXT_FIELDS)))
+    
+    def blocking(prompt):
+        yield ask_gemini_cached(prompt, "", ask=offline_llm)
+    
+    paths = {
+        "blocking ask": blocking,
+        "streamed (stub)": lambda prompt: ask_gemini_streaming(prompt, "", stream=offline_stream, ask=offline_llm),
+        # The app's path: model routing, hedging thread and queue around the same stub stream
+        "streamed (stream_gemini)": lambda prompt: ask_gemini_streaming(prompt, "", ask=offline_llm),
+    }
+    stream_model_text, model_router = pipeline.stream_model_text, pipeline.model_router
+    pipeline.stream_model_text = lambda model_name, prompt, api_key: offline_stream(prompt, api_key)
+    pipeline.model_router = ModelRouter()
+    try:
+        print(f"{len(prompts)} questions, {offline.LATENCY['llm']:g}s to first token, "
+              f"{offline.LATENCY['chunk']:g}s per chunk")
+        for name, answer in paths.items():
+            timings = [time_answer(answer(prompt)) for prompt in prompts]
+            firsts = [first for first, _ in timings]
+            totals = [total for _, total in timings]
+            print(f"{name:26} first chunk p50 {1000 * statistics.median(firsts):7.1f} ms  "
+                  f"p95 {1000 * percentile(firsts, 0.95):7.1f} ms  |  "
+                  f"full answer p50 {1000 * statistics.median(totals):7.1f} ms")
+    finally:
+        pipeline.stream_model_text, pipeline.model_router = stream_model_text, model_router
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Verse2Vision pipeline.")
+    parser.add_argument("--kb", default="kb.json", help="Knowledge base path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    flows = subparsers.add_parser("flows", help="End-to-end timing of the four app flows")
+    flows.add_argument("--flow", nargs="*", choices=list(FLOWS), help="Flows to run (default: all)")
+    flows.add_argument("--iterations", type=int, default=20, help="Runs per flow")
+    flows.add_argument("--save-baseline", help="Write the results to this JSON file")
+    flows.add_argument("--baseline", help="Fail if results regress against this JSON file")
+    flows.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    flows.add_argument("--rate-limits", action="store_true", help="Keep the per-backend call rate limits")
+    flows.set_defaults(handler=run_flows, llm_latency=0.0, image_latency=0.0, tts_latency=0.0)
+    
+    retrieval = subparsers.add_parser("retrieval", help="Relevance and latency of TF-IDF vs hybrid retrieval")
+    retrieval.add_argument("--top-k", type=int, default=5, help="Verses retrieved per query")
+    retrieval.set_defaults(handler=run_retrieval)
+    
+    scheduler = subparsers.add_parser("scheduler", help="Load test of the background job scheduler")
+    scheduler.add_argument("--sessions", type=int, default=40, help="Concurrent simulated sessions")
+    scheduler.add_argument("--topics", type=int, default=15, help="Distinct story topics across sessions")
+    scheduler.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between job polls")
+    scheduler.set_defaults(handler=run_scheduler, llm_latency=0.3, image_latency=0.5, tts_latency=0.05)
+    
+    context = subparsers.add_parser("context", help="Prompt size with and without context packing")
+    context.add_argument("--top-k", type=int, default=5, help="Verses retrieved per query")
+    context.set_defaults(handler=run_context)
+    
+    startup = subparsers.add_parser("startup", help="load_resources() with an empty vs a filled cache")
+    startup.add_argument("--iterations", type=int, default=5, help="Cold/warm pairs to run")
+    startup.set_defaults(handler=run_startup)
+    
+    tracing = subparsers.add_parser("tracing", help="Cost of span() with tracing off and on")
+    tracing.add_argument("--spans", type=int, default=200000, help="Blocks timed per repeat")
+    tracing.add_argument("--repeats", type=int, default=5, help="Repeats; the best is reported")
+    tracing.add_argument("--export", action="store_true", help="Also time spans appended to a JSON lines file")
+    tracing.set_defaults(handler=run_tracing)
+    
+    ttfb = subparsers.add_parser("ttfb", help="Time to first chunk of streamed vs blocking answers")
+    ttfb.add_argument("--questions", type=int, default=10, help="Questions to answer per path")
+    ttfb.add_argument("--llm-latency", type=float, help="Seconds before the first chunk")
+    ttfb.add_argument("--chunk-latency", type=float, help="Seconds per streamed chunk")
+    ttfb.set_defaults(handler=run_ttfb, llm_latency=0.3, chunk_latency=0.02)
+    
+    for subparser in (flows, scheduler):
+        subparser.add_argument("--llm-latency", type=float, help="Seconds per LLM call")
+        subparser.add_argument("--chunk-latency", type=float, help="Seconds per streamed LLM chunk")
+        subparser.add_argument("--image-latency", type=float, help="Seconds per image")
+        subparser.add_argument("--tts-latency", type=float, help="Seconds per TTS call")
+        subparser.add_argument("--caption-latency", type=float, default=0.0, help="Seconds per caption")
+    
+    args = parser.parse_args(argv)
+    for name in offline.LATENCY:
+        latency = getattr(args, f"{name}_latency", None)
+        if latency is not None:
+            offline.LATENCY[name] = latency
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Deterministic stand-ins for the Gemini, image and TTS backends.
+
+Used by `batch_render.py --offline` and the benchmarks to run the pipeline
+without network access or an API key. LATENCY adds a fixed delay per call
+(and per streamed chunk) so runs can model realistic service times.
+"""
+import hashlib
+import json
+import time
+
+from PIL import Image
+
+from pipeline import SCENE_COUNT
+
+
+# Simulated service time per call, in seconds; "chunk" is the generation time of each streamed chunk
+LATENCY = {"llm": 0.0, "chunk": 0.0, "image": 0.0, "tts": 0.0, "caption": 0.0}
+CHUNK_CHARS = 32
+
+# Silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, mono, ~26 ms): a header with an all-zero body
+SILENT_MP3_FRAME = b"\xff\xfb\x90\xc4" + bytes(413)
+SPEECH_FRAMES_PER_CHAR = 3  # ~80 ms of audio per character of text
+
+
+def _seed(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:6]
+
+
+def _scene(seed: str, number: int) -> dict:
+    return {
+        "visual": f"Scene {number} of story {seed}, Hanuman in a forest clearing",
+        "subtitle": f"Part {number} of the story",
+    }
+
+
+def offline_stream(prompt: str, api_key: str):
+    """Yield a streamed answer in small chunks.
+    
+    Scene planning prompts get a JSON array of SCENE_COUNT scenes; any other
+    prompt gets a few sentences of prose.
+    """
+    time.sleep(LATENCY["llm"])
+    seed = _seed(prompt)
+    if "JSON array" in prompt:
+        text = json.dumps([_scene(seed, i) for i in range(1, SCENE_COUNT + 1)])
+    else:
+        text = " ".join(f"Sentence {i} of answer {seed} tells how Hanuman served Rama." for i in range(1, 5))
+    for start in range(0, len(text), CHUNK_CHARS):
+        time.sleep(LATENCY["chunk"])
+        yield text[start:start + CHUNK_CHARS]
+
+
+def offline_llm(prompt: str, api_key: str) -> str:
+    """Return a single JSON scene for repair prompts, otherwise a free-text scene plan.
+    
+    The reply arrives only once all of it has been generated, at the same
+    per-chunk rate as offline_stream().
+    """
+    seed = _seed(prompt)
+    if "Return ONLY scene" in prompt:
+        text = json.dumps(_scene(seed, 1))
+    else:
+        scenes = [_scene(seed, i) for i in range(1, SCENE_COUNT + 1)]
+        text = "\n\n".join(
+            f"IMAGE {i}:\nVISUAL: {scene['visual']}\nSUBTITLE: \"{scene['subtitle']}\""
+            for i, scene in enumerate(scenes, 1)
+        )
+    time.sleep(LATENCY["llm"] + LATENCY["chunk"] * -(-len(text) // CHUNK_CHARS))
+    return text
+
+
+def offline_image(prompt: str, method: str = "pollinations"):
+    """Solid-colour placeholder image derived from the prompt."""
+    time.sleep(LATENCY["image"])
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return Image.new("RGB", (256, 256), tuple(digest[:3]))
+
+
+def offline_speech(text: str) -> bytes:
+    """Silent but playable MP3 whose duration grows with the text length."""
+    time.sleep(LATENCY["tts"])
+    return SILENT_MP3_FRAME * max(1, len(text) * SPEECH_FRAMES_PER_CHAR)
+
+
+def offline_caption(image, api_key: str) -> str:
+    """Describe an image by its average colour."""
+    time.sleep(LATENCY["caption"])
+    red, green, blue = image.convert("RGB").resize((1, 1), Image.BOX).getpixel((0, 0))
+    return f"Hanuman standing in a scene tinted rgb({red}, {green}, {blue})"
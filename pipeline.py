@@ -0,0 +1,2001 @@
+"""Retrieval, generation and caching pipeline shared by the Streamlit app and batch_render.py.
+
+Nothing here depends on Streamlit. Process-wide objects (caches, the job
+scheduler) are created by the caller and passed in; backend limits and
+streaming model health are module-level, so they are shared by every
+thread in the process.
+"""
+import contextvars
+import copy
+import hashlib
+import io
+import json
+import os
+import pickle
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from rag.loader import load_kb
+from rag.generator import (
+    ask_gemini, build_image_to_text_prompt,
+    build_sequential_story_images_prompt, parse_sequential_image_descriptions
+)
+from rag.vision import caption_image
+from rag.image_generator import generate_image_from_prompt
+from rag.tts import generate_speech
+
+from google.ai import generativelanguage as glm
+
+
+# On-disk cache for fitted retrieval indexes (keyed by kb.json content hash)
+CACHE_DIR = Path(".cache")
+
+# LLM response cache bounds (in memory, plus an optional SQLite file)
+LLM_CACHE_SIZE = 256
+LLM_CACHE_TTL = 6 * 60 * 60  # seconds
+LLM_FALLBACK_CACHE_TTL = 30 * 60  # seconds, for answers from a model other than the preferred one
+LLM_DISK_CACHE_SIZE = 10_000  # rows kept in the SQLite file
+
+# Field-aware keyword (BM25) scoring, fused with the TF-IDF cosine score
+FIELD_BOOSTS = {
+    "keywords": 3.0,
+    "tags": 2.5,
+    "emotion": 1.5,
+    "meaning_simple_en": 1.5,
+    "text_transliteration": 1.0,
+    "text_sanskrit": 1.0,
+    "meaning_detailed_en": 1.0,
+    "context_story_en": 0.8,
+    "story_seed_en": 0.8,
+    "image_prompt_en": 0.5,
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+HYBRID_ALPHA = 0.5  # weight of the TF-IDF cosine score; BM25 gets the rest
+# Fields embedded (concatenated) for the TF-IDF cosine score
+TFIDF_FIELDS = ("text_transliteration", "meaning_simple_en", "meaning_detailed_en", "tags")
+
+# Retrieval result cache and related-verse graph
+RETRIEVAL_CACHE_SIZE = 512
+NEIGHBOR_COUNT = 5
+STORY_CONTEXT_NEIGHBORS = 1  # related verses added to text story context
+
+# Prompt context packing: verse text per prompt is cut to a token budget,
+# keeping the highest value (field weight x verse score) sentences first
+CONTEXT_TOKEN_BUDGET = 700
+CONTEXT_SENTENCE_DECAY = 0.85  # later sentences of a field are worth less
+QA_CONTEXT_FIELDS = {
+    "meaning_simple_en": 1.0,
+    "meaning_detailed_en": 0.8,
+    "text_transliteration": 0.6,
+    "text_sanskrit": 0.5,
+    "context_story_en": 0.4,
+    "story_seed_en": 0.2,
+}
+STORY_CONTEXT_FIELDS = {
+    "story_seed_en": 1.0,
+    "context_story_en": 0.9,
+    "meaning_simple_en": 0.8,
+    "meaning_detailed_en": 0.5,
+    "text_transliteration": 0.4,
+    "text_sanskrit": 0.3,
+}
+IMAGE_CONTEXT_FIELDS = {
+    "meaning_simple_en": 1.0,
+    "context_story_en": 0.8,
+    "meaning_detailed_en": 0.6,
+    "text_transliteration": 0.4,
+    "story_seed_en": 0.3,
+    "text_sanskrit": 0.3,
+}
+
+# Models for streamed answers in order of preference (ask_gemini remains the fallback)
+STREAM_MODELS = ("gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.0-flash", "gemini-flash-latest")
+MODEL_FAILURE_THRESHOLD = 2  # consecutive failures before a model is skipped
+MODEL_RESET_TIMEOUT = 60.0  # seconds before a skipped model is probed again
+MODEL_STATS_WINDOW = 300.0  # seconds of calls used for latency and error rate
+MODEL_MIN_SAMPLES = 5  # calls in the window before a model can be demoted
+MODEL_SLOW_P95 = 8.0  # seconds to first chunk (p95) beyond which a model is tried last
+MODEL_MAX_ERROR_RATE = 0.5  # error rate beyond which a model is tried last
+MODEL_HEDGE_AFTER = 4.0  # seconds without a first chunk before the next model is raced
+BLOCKING_MODEL = "ask_gemini"  # recorded for answers from the blocking fallback chain
+LLM_CLIENT_CACHE_SIZE = 64  # per-key Gemini clients kept alive
+
+# Structured scene planning
+SCENE_COUNT = 3
+SCENE_JSON_INSTRUCTIONS = """
+
+Return ONLY a JSON array of exactly {count} objects, one per image in story order, with no other text:
+[{{"visual": "<detailed visual description>", "subtitle": "<short child-friendly subtitle>"}}]"""
+SCENE_REPAIR_INSTRUCTIONS = """
+
+Scenes planned so far:
+{scenes}
+
+Return ONLY scene {number} as a single JSON object, with no other text:
+{{"visual": "<detailed visual description>", "subtitle": "<short child-friendly subtitle>"}}"""
+
+# Scene image generation limits
+SCENE_CONCURRENCY = 3
+SCENE_TIMEOUT = 60  # seconds per scene
+SCENE_RETRIES = 1
+SCENE_BACKOFF = 1.0  # seconds, doubled on each retry
+
+# Image service circuit breaker
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 30.0  # seconds
+
+# Generated image cache bounds
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+IMAGE_CACHE_MEMORY_SIZE = 32
+
+# Image analysis preprocessing and caption cache
+CAPTION_MAX_SIDE = 1024
+CAPTION_JPEG_QUALITY = 85
+CAPTION_CACHE_SIZE = 256
+CAPTION_HASH_DISTANCE = 4  # max differing dHash bits for a near-duplicate
+CAPTION_COLOR_TOLERANCE = 24  # max per-channel difference of the coarse colour layout
+CAPTION_ASPECT_TOLERANCE = 0.05  # max relative difference in aspect ratio
+
+# Narration audio cache and synthesis limits
+AUDIO_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TTS_CONCURRENCY = 4
+
+# Span latency histogram bounds
+TRACE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+
+# Background jobs: long generations run off the session thread
+JOB_WORKERS = 8  # shared by every session
+JOB_MAX_QUEUED = 3  # per user; each user's jobs run one at a time
+JOB_RETENTION = 10 * 60  # seconds a finished job stays available for polling
+
+# Process-wide limits per backend: (max concurrent calls, max calls per second)
+BACKEND_LIMITS = {
+    "llm": (4, 2.0),
+    "image": (6, 3.0),
+    "tts": (4, 5.0),
+}
+BACKEND_ACQUIRE_TIMEOUT = 30.0  # seconds to wait for a free slot before giving up
+
+
+def kb_digest(kb_path: Path) -> str:
+    """Return a SHA-256 hash of the knowledge base file contents."""
+    digest = hashlib.sha256()
+    # Hash in blocks so large multi-text corpora are never fully buffered
+    with open(kb_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Tracer:
+    """Collects timing spans for user actions.
+    
+    Keeps the most recent spans for the diagnostics panel, per-span-name
+    counters and latency histograms for Prometheus-style export, and
+    optionally appends every span to a JSON lines file.
+    """
+    
+    def __init__(self, export_path: str = "", max_spans: int = 1000):
+        self.export_path = export_path
+        self.spans = deque(maxlen=max_spans)
+        self._histograms = {}
+        self._lock = threading.Lock()
+    
+    def record(self, trace_id: str, name: str, start: float, duration: float, error: str = None) -> None:
+        span = {
+            "trace_id": trace_id,
+            "name": name,
+            "start": start,
+            "duration_ms": round(duration * 1000, 3),
+            "error": error,
+        }
+        with self._lock:
+            self.spans.append(span)
+            histogram = self._histograms.setdefault(
+                name, {"count": 0, "errors": 0, "sum": 0.0, "buckets": [0] * len(TRACE_BUCKETS)}
+            )
+            histogram["count"] += 1
+            histogram["sum"] += duration
+            if error:
+                histogram["errors"] += 1
+            for i, bound in enumerate(TRACE_BUCKETS):
+                if duration <= bound:
+                    histogram["buckets"][i] += 1
+            if self.export_path:
+                try:
+                    with open(self.export_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(span) + "\n")
+                except OSError:
+                    pass
+    
+    def to_jsonl(self) -> str:
+        """Return the recent spans as JSON lines."""
+        with self._lock:
+            return "".join(json.dumps(span) + "\n" for span in self.spans)
+    
+    def to_prometheus(self) -> str:
+        """Return span counters and latency histograms in Prometheus text format."""
+        lines = [
+            "# TYPE verse2vision_span_seconds histogram",
+            "# TYPE verse2vision_span_errors_total counter",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(TRACE_BUCKETS, histogram["buckets"]):
+                    lines.append(f'verse2vision_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'verse2vision_span_seconds_bucket{{span="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'verse2vision_span_seconds_sum{{span="{name}"}} {histogram["sum"]:.6f}')
+                lines.append(f'verse2vision_span_seconds_count{{span="{name}"}} {histogram["count"]}')
+                lines.append(f'verse2vision_span_errors_total{{span="{name}"}} {histogram["errors"]}')
+        return "\n".join(lines) + "\n"
+
+
+# (trace_id, tracer) for the user action being handled, None when not tracing
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class _Span:
+    __slots__ = ("trace_id", "tracer", "name", "start", "wall_start")
+    
+    def __init__(self, trace_id: str, tracer: Tracer, name: str):
+        self.trace_id = trace_id
+        self.tracer = tracer
+        self.name = name
+    
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        error = None
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            error = exc_type.__name__
+        self.tracer.record(self.trace_id, self.name, self.wall_start, time.perf_counter() - self.start, error)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str):
+    """Time a block as part of the current trace; a no-op when not tracing."""
+    current = _current_trace.get()
+    if current is None:
+        return _NO_SPAN
+    return _Span(current[0], current[1], name)
+
+
+@contextmanager
+def start_trace(action: str, tracer: Tracer):
+    """Record everything inside the block as one trace, under a span named action."""
+    token = _current_trace.set((uuid.uuid4().hex[:16], tracer))
+    try:
+        with span(action):
+            yield
+    finally:
+        _current_trace.reset(token)
+
+
+class FieldBM25Index:
+    """Field-aware BM25 over KB entries with per-field boosts, plus TF-IDF vectors.
+    
+    Every field is scored with its own BM25 length normalization and IDF;
+    the boosted field weights are summed into one sparse doc x term matrix
+    at build time, so scoring a query is a single sparse product. The
+    TF-IDF side embeds the concatenated tfidf_fields of each entry as
+    unit-length rows, so cosine similarity is a sparse product as well.
+    """
+    
+    def __init__(self, entries, boosts: dict = FIELD_BOOSTS, k1: float = BM25_K1, b: float = BM25_B,
+                 tfidf_fields=TFIDF_FIELDS):
+        self.entries = entries
+        self.positions = {entry.id: i for i, entry in enumerate(entries)}
+        field_texts = {field: [self._field_text(entry, field) for entry in entries] for field in boosts}
+        
+        # Include Devanagari vowel signs in tokens so Sanskrit words stay whole
+        self.vectorizer = CountVectorizer(lowercase=True, token_pattern=r"[\w\u0900-\u097F]+")
+        self.vectorizer.fit([text for texts in field_texts.values() for text in texts])
+        
+        n_docs = len(entries)
+        weights = None
+        for field, boost in boosts.items():
+            tf = self.vectorizer.transform(field_texts[field]).tocsr().astype(np.float64)
+            doc_len = np.asarray(tf.sum(axis=1)).ravel()
+            avg_len = doc_len.mean() or 1.0
+            df = np.bincount(tf.indices, minlength=tf.shape[1])
+            idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+            norm = k1 * (1 - b + b * doc_len / avg_len)
+            rows = np.repeat(np.arange(n_docs), np.diff(tf.indptr))
+            tf.data = boost * idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + norm[rows])
+            weights = tf if weights is None else weights + tf
+        self.weights = weights.tocsr()
+        
+        self.tfidf = TfidfVectorizer(lowercase=True, token_pattern=r"[\w\u0900-\u097F]+")
+        self.tfidf_vectors = self.tfidf.fit_transform(
+            [" ".join(self._field_text(entry, field) for field in tfidf_fields) for entry in entries]
+        ).tocsr()
+    
+    @staticmethod
+    def _field_text(entry, field: str) -> str:
+        value = getattr(entry, field, "") or ""
+        return " ".join(value) if isinstance(value, (list, tuple)) else str(value)
+    
+    def score(self, query: str) -> np.ndarray:
+        """Return the BM25 score of every entry for query."""
+        return self.score_batch([query])[0]
+    
+    def score_batch(self, queries) -> np.ndarray:
+        """Return BM25 scores as a (queries x entries) array, in one sparse product."""
+        query_terms = self.vectorizer.transform(queries)
+        query_terms.data[:] = 1.0
+        return (self.weights @ query_terms.T).toarray().T
+    
+    def cosine(self, query: str) -> np.ndarray:
+        """Return the TF-IDF cosine similarity of every entry to query."""
+        return self.cosine_batch([query])[0]
+    
+    def cosine_batch(self, queries) -> np.ndarray:
+        """Return TF-IDF cosine similarities as a (queries x entries) array."""
+        return (self.tfidf_vectors @ self.tfidf.transform(queries).T).toarray().T
+
+
+def hybrid_retrieve(query: str, index: FieldBM25Index, top_k: int = 5, alpha: float = HYBRID_ALPHA):
+    """Retrieve verses by fusing TF-IDF cosine and field-boosted BM25 scores.
+    
+    BM25 scores are scaled to [0, 1] by the best match so the two scores
+    are comparable. Returns (KBEntry, score) pairs like retrieve_verses().
+    """
+    return retrieve_batch([query], index, top_k, alpha)[0]
+
+
+def retrieve_batch(queries, index: FieldBM25Index, top_k: int = 5, alpha: float = HYBRID_ALPHA) -> list:
+    """hybrid_retrieve() for many queries at once, scoring them all in one pass.
+    
+    Returns one list of (KBEntry, score) pairs per query.
+    """
+    queries = list(queries)
+    if not queries:
+        return []
+    cosine = index.cosine_batch(queries)
+    bm25 = index.score_batch(queries)
+    best = bm25.max(axis=1, keepdims=True)
+    bm25 = np.divide(bm25, best, out=np.zeros_like(bm25), where=best > 0)
+    
+    fused = alpha * cosine + (1 - alpha) * bm25
+    top = np.argsort(-fused, axis=1, kind="stable")[:, :top_k]
+    return [[(index.entries[i], float(row[i])) for i in rows if row[i] > 0] for row, rows in zip(fused, top)]
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for result caching (case, whitespace, end punctuation)."""
+    return " ".join(query.casefold().split()).strip(" ?!.")
+
+
+class QueryCache:
+    """LRU of retrieval results keyed by (normalized query, top_k)."""
+    
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+    
+    def put(self, key, results) -> None:
+        with self._lock:
+            self._entries[key] = results
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def _select_top_k(scores: np.ndarray, candidates: np.ndarray, k: int):
+    """Pick the k best candidates per row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return candidates[:, :0], scores[:, :0]
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    best = np.take_along_axis(best, order, axis=1)
+    return np.take_along_axis(candidates, best, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class NeighborGraph:
+    """k-nearest-neighbor graph over verse vectors (cosine similarity).
+    
+    Stored as dense (verses x k) arrays of neighbor rows and similarities,
+    persisted as .npz alongside the other index caches. row_digests
+    fingerprints the vector each row was built from.
+    """
+    
+    def __init__(self, ids, neighbors: np.ndarray, scores: np.ndarray, kb_hash: str = "", row_digests=None):
+        self.ids = list(ids)
+        self.neighbors = neighbors
+        self.scores = scores
+        self.kb_hash = kb_hash
+        self.row_digests = list(row_digests) if row_digests is not None else None
+        self.positions = {verse_id: i for i, verse_id in enumerate(self.ids)}
+    
+    @classmethod
+    def build(cls, vectors, ids, kb_hash: str = "", k: int = NEIGHBOR_COUNT, previous=None,
+              block_size: int = 1024):
+        """Build the graph from row vectors (one per verse).
+        
+        previous is reused as is when it was built for the same ids from
+        identical vectors (e.g. kb.json changed only in fields the index
+        does not cover); otherwise every row is rebuilt. Rows are not
+        merged incrementally: the index is refit on every KB change, which
+        moves IDF and average lengths and so changes every verse's vector.
+        """
+        ids = list(ids)
+        vectors = normalize(vectors).tocsr()
+        n_verses = len(ids)
+        k = min(k, max(n_verses - 1, 0))
+        row_digests = [
+            hashlib.blake2b(
+                vectors.indices[start:stop].tobytes() + vectors.data[start:stop].tobytes(), digest_size=8
+            ).hexdigest()
+            for start, stop in zip(vectors.indptr[:-1], vectors.indptr[1:])
+        ]
+        if (
+            previous is not None and previous.ids == ids and previous.row_digests == row_digests
+            and previous.neighbors.shape[1] == k
+        ):
+            return cls(ids, previous.neighbors, previous.scores, kb_hash, row_digests)
+        
+        neighbors = np.zeros((n_verses, k), dtype=np.int64)
+        scores = np.zeros((n_verses, k))
+        all_rows = np.arange(n_verses)
+        for start in range(0, n_verses, block_size):
+            stop = min(start + block_size, n_verses)
+            similarity = (vectors[start:stop] @ vectors.T).toarray()
+            similarity[np.arange(stop - start), np.arange(start, stop)] = -np.inf  # not your own neighbor
+            candidates = np.broadcast_to(all_rows, similarity.shape)
+            neighbors[start:stop], scores[start:stop] = _select_top_k(similarity, candidates, k)
+        return cls(ids, neighbors, scores, kb_hash, row_digests)
+    
+    def related(self, verse_id: str) -> list:
+        """Return (verse id, similarity) pairs for a verse's neighbors, best first."""
+        row = self.positions.get(verse_id)
+        if row is None:
+            return []
+        return [
+            (self.ids[neighbor], float(score))
+            for neighbor, score in zip(self.neighbors[row], self.scores[row])
+            if score > 0
+        ]
+    
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp_path, ids=np.array(self.ids), neighbors=self.neighbors, scores=self.scores,
+                 kb_hash=np.array(self.kb_hash), row_digests=np.array(self.row_digests or []))
+        tmp_path.replace(path)
+    
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path, allow_pickle=False) as data:
+            # Graphs saved before row digests existed are never reused
+            row_digests = data["row_digests"].tolist() if "row_digests" in data else None
+            return cls(data["ids"].tolist(), data["neighbors"], data["scores"], str(data["kb_hash"]),
+                       row_digests or None)
+
+
+def expand_with_neighbors(results, graph: NeighborGraph, index: FieldBM25Index, limit: int):
+    """Add related verses of the retrieved ones (best hits first) up to limit entries."""
+    expanded = list(results)
+    seen = {entry.id for entry, _ in results}
+    for entry, score in results:
+        for neighbor_id, similarity in graph.related(entry.id):
+            if len(expanded) >= limit:
+                return expanded
+            if neighbor_id not in seen:
+                seen.add(neighbor_id)
+                expanded.append((index.entries[index.positions[neighbor_id]], score * similarity))
+    return expanded
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate LLM token count (about 4 UTF-8 bytes per token)."""
+    return -(-len(text.encode("utf-8")) // 4)
+
+
+class ContextPacker:
+    """Cuts retrieved verses down to a token budget before prompt building.
+    
+    Every weighted field of an entry is split into sentences whose token
+    counts are computed once and cached per entry. pack() keeps sentences
+    in order of verse score x field weight (later sentences of a field
+    count for less), skips sentences already kept from another field or
+    verse, and stops adding once the budget is spent. Low-value fields are
+    therefore the ones truncated or blanked; fields that are not weighted
+    are left as they are.
+    """
+    
+    def __init__(self, entries, fields=(QA_CONTEXT_FIELDS, STORY_CONTEXT_FIELDS, IMAGE_CONTEXT_FIELDS)):
+        self._fields = sorted({field for weights in fields for field in weights})
+        self._sentences = {}  # entry id -> {field: [(sentence, normalized, tokens)]}
+        self._lock = threading.Lock()
+        self.full_tokens = 0
+        self.packed_tokens = 0
+        for entry in entries:
+            self._entry_sentences(entry)
+    
+    def _entry_sentences(self, entry) -> dict:
+        sentences = self._sentences.get(entry.id)
+        if sentences is None:
+            sentences = {
+                field: [(sentence, normalize_query(sentence), estimate_tokens(sentence))
+                        for sentence in split_sentences(getattr(entry, field, None) or "")]
+                for field in self._fields
+            }
+            self._sentences[entry.id] = sentences
+        return sentences
+    
+    def pack(self, results, weights: dict, budget: int = CONTEXT_TOKEN_BUDGET):
+        """Return (entry, score) pairs whose weighted fields fit within budget tokens.
+        
+        Entries are shallow copies with the weighted fields cut down;
+        entries left with no weighted text are dropped. The best sentence is
+        always kept, even if it alone exceeds the budget.
+        """
+        top_score = max((score for _, score in results), default=0.0) or 1.0
+        candidates = []
+        full = 0
+        for rank, (entry, score) in enumerate(results):
+            sentences = self._entry_sentences(entry)
+            for field, weight in weights.items():
+                for position, (_, normalized, tokens) in enumerate(sentences.get(field, ())):
+                    full += tokens
+                    value = score / top_score * weight * CONTEXT_SENTENCE_DECAY ** position
+                    candidates.append((-value, rank, field, position, normalized, tokens))
+        candidates.sort()
+        
+        kept = set()
+        seen = set()
+        used = 0
+        for _, rank, field, position, normalized, tokens in candidates:
+            if normalized in seen:
+                continue
+            if kept and used + tokens > budget:
+                continue
+            seen.add(normalized)
+            kept.add((rank, field, position))
+            used += tokens
+        
+        with self._lock:
+            self.full_tokens += full
+            self.packed_tokens += used
+        
+        packed = []
+        for rank, (entry, score) in enumerate(results):
+            sentences = self._entry_sentences(entry)
+            trimmed = copy.copy(entry)
+            has_text = False
+            for field in weights:
+                text = " ".join(
+                    sentence for position, (sentence, _, _) in enumerate(sentences.get(field, ()))
+                    if (rank, field, position) in kept
+                )
+                setattr(trimmed, field, text)
+                has_text = has_text or bool(text)
+            if has_text:
+                packed.append((trimmed, score))
+        return packed
+
+
+def load_resources(kb_path: str, kb_hash: str):
+    """Load KB entries, the fitted retrieval index, the related-verse graph
+    and the prompt context packer.
+    
+    The fitted index is pickled under CACHE_DIR
+    keyed by the KB hash, so a process restart only refits when kb.json
+    actually changes; pickles for older KB versions are deleted when a new
+    one is written. The neighbor graph is persisted next to it and
+    reused while the verses' keyword vectors are unchanged.
+    """
+    entries = load_kb(Path(kb_path))
+    context_packer = ContextPacker(entries)
+    
+    cache_file = CACHE_DIR / f"index_{kb_hash[:16]}.pkl"
+    keyword_index = None
+    if cache_file.exists():
+        try:
+            with open(cache_file, "rb") as f:
+                keyword_index = pickle.load(f)
+        except Exception:
+            # Corrupt or incompatible cache - rebuild below
+            keyword_index = None
+    
+    if keyword_index is None:
+        keyword_index = FieldBM25Index(entries)
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            tmp_file = cache_file.with_suffix(".tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump(keyword_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_file.replace(cache_file)
+            # Only the current KB version is ever loaded (embeddings_*.pkl held the old EmbeddingStore)
+            for stale_file in [*CACHE_DIR.glob("index_*.pkl"), *CACHE_DIR.glob("embeddings_*.pkl")]:
+                if stale_file != cache_file:
+                    stale_file.unlink(missing_ok=True)
+        except Exception:
+            # Caching is best-effort; the in-memory index is still usable
+            pass
+    
+    graph_file = CACHE_DIR / "neighbors.npz"
+    try:
+        previous_graph = NeighborGraph.load(graph_file)
+    except Exception:
+        previous_graph = None
+    
+    if previous_graph is not None and previous_graph.kb_hash == kb_hash:
+        neighbor_graph = previous_graph
+    else:
+        neighbor_graph = NeighborGraph.build(
+            keyword_index.weights, [entry.id for entry in entries], kb_hash, previous=previous_graph
+        )
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            neighbor_graph.save(graph_file)
+        except Exception:
+            pass
+    
+    return entries, keyword_index, neighbor_graph, context_packer
+
+
+class BackendLimiter:
+    """Caps concurrent calls and the call rate to one backend service.
+    
+    Used as a context manager around each call. Callers beyond the
+    concurrency limit block until a slot frees up; calls are also spaced
+    at least 1 / rate seconds apart. A thread that already holds a slot
+    (e.g. a scene repair issued mid-stream) passes straight through, so
+    nested calls cannot deadlock.
+    
+    slots may be a semaphore shared with other processes, in which case
+    the concurrency limit spans them all (the rate stays per process).
+    
+    Waiting for a slot gives up with TimeoutError after timeout seconds, so
+    calls that hang while holding every slot cannot stall later callers
+    indefinitely.
+    """
+    
+    def __init__(self, concurrency: int, rate: float, slots=None, timeout: float = BACKEND_ACQUIRE_TIMEOUT):
+        self._slots = slots if slots is not None else threading.BoundedSemaphore(concurrency)
+        self._interval = 1.0 / rate
+        self.timeout = timeout
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+        self._held = threading.local()
+        self.calls = 0
+        self.waited = 0.0  # total seconds callers spent waiting
+    
+    def __enter__(self):
+        depth = getattr(self._held, "depth", 0)
+        if depth:
+            self._held.depth = depth + 1
+            return self
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.waited += time.perf_counter() - start
+            raise TimeoutError(f"Backend busy: no free slot after {self.timeout:g}s")
+        self._held.depth = 1
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_start)
+            self._next_start = slot + self._interval
+            self.calls += 1
+        if slot > now:
+            time.sleep(slot - now)
+        with self._lock:
+            self.waited += time.perf_counter() - start
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self._held.depth -= 1
+        if not self._held.depth:
+            self._slots.release()
+        return False
+
+
+# Process-wide limiters for the LLM, image and TTS backends
+backend_limits = {name: BackendLimiter(*limits) for name, limits in BACKEND_LIMITS.items()}
+
+
+class ResponseCache:
+    """LRU of LLM responses keyed by prompt, with a TTL.
+    
+    Each entry records the model that produced it (None when unknown), so
+    answers from a fallback model can be stored with a shorter TTL. With a
+    path, entries are also written to a SQLite file and survive restarts;
+    memory misses are looked up there and promoted.
+    """
+    
+    def __init__(self, max_entries: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL, path: Path = None,
+                 max_disk_entries: int = LLM_DISK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = Path(path) if path is not None else None
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires at, response, model)
+        self._lock = threading.Lock()
+        self._db = None
+    
+    @staticmethod
+    def key(prompt: str) -> str:
+        """Return the fingerprint of a built prompt."""
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    
+    def _connect(self):
+        """Open the SQLite file on first use; returns None without a path or on error."""
+        if self._db is None and self.path is not None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(str(self.path), timeout=5.0, check_same_thread=False)
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "model TEXT, expires REAL NOT NULL, used REAL NOT NULL)"
+                )
+                db.commit()
+                self._db = db
+            except sqlite3.Error:
+                # Disk caching is best-effort; stay in memory only
+                self.path = None
+        return self._db
+    
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def get_entry(self, prompt: str):
+        """Return (response, model) for prompt, or None."""
+        key = self.key(prompt)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now > entry[0]:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+    
+    def get(self, prompt: str):
+        """Return the cached response for prompt, or None."""
+        entry = self.get_entry(prompt)
+        return entry[0] if entry is not None else None
+    
+    def put(self, prompt: str, response: str, model: str = None, ttl: float = None) -> None:
+        """Store a response, evicting the least recently used over the bound."""
+        key = self.key(prompt)
+        now = time.time()
+        entry = (now + (self.ttl if ttl is None else ttl), response, model)
+        with self._lock:
+            self._remember(key, entry)
+            self._store(key, entry, now)
+    
+    def _load(self, key: str, now: float):
+        db = self._connect()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT expires, response, model FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now > row[0]:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+                self.evictions += 1
+                return None
+            db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            db.commit()
+            return tuple(row)
+        except sqlite3.Error:
+            return None
+    
+    def _store(self, key: str, entry: tuple, now: float) -> None:
+        db = self._connect()
+        if db is None:
+            return
+        expires, response, model = entry
+        try:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, model, expires, used) VALUES (?, ?, ?, ?, ?)",
+                (key, response, model, expires, now),
+            )
+            db.execute("DELETE FROM responses WHERE expires < ?", (now,))
+            db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+            db.commit()
+        except sqlite3.Error:
+            pass
+
+
+def response_ttl(model: str):
+    """Return the cache TTL for an answer from model, or None for the cache default.
+    
+    Answers from anything but the preferred streaming model (a hedge, a
+    fallback, or the blocking chain) expire sooner, so the preferred model
+    gets to answer the prompt again once it recovers.
+    """
+    if model is None or model == model_router.models[0]:
+        return None
+    return LLM_FALLBACK_CACHE_TTL
+
+
+# rag.generator and rag.vision call genai.configure() before each request,
+# which swaps the process-wide client; calls with different keys must not interleave
+_genai_lock = threading.Lock()
+
+
+def ask_gemini_serialized(prompt: str, api_key: str) -> str:
+    """ask_gemini(), made safe to call from several sessions at once."""
+    with _genai_lock:
+        return ask_gemini(prompt, api_key)
+
+
+def caption_image_serialized(image, api_key: str) -> str:
+    """caption_image(), made safe to call from several sessions at once."""
+    with _genai_lock:
+        return caption_image(image, api_key)
+
+
+def ask_gemini_cached(prompt: str, api_key: str, cache: ResponseCache = None, ask=ask_gemini_serialized) -> str:
+    """Ask Gemini, reusing the answer when the same prompt was already sent."""
+    response = cache.get(prompt) if cache is not None else None
+    if response is None:
+        with span("ask_gemini"), backend_limits["llm"]:
+            response = ask(prompt, api_key)
+        if cache is not None:
+            cache.put(prompt, response)
+    return response
+
+
+@lru_cache(maxsize=LLM_CLIENT_CACHE_SIZE)
+def generative_client(api_key: str):
+    """Return a Gemini client bound to api_key.
+    
+    Each key gets its own client, so concurrent sessions never send a
+    request under another session's key.
+    """
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+
+def stream_model_text(model_name: str, prompt: str, api_key: str):
+    """Yield the text of each streamed response chunk from one model."""
+    request = glm.GenerateContentRequest(
+        model=f"models/{model_name}",
+        contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+    )
+    for response in generative_client(api_key).stream_generate_content(request=request):
+        yield "".join(part.text for candidate in response.candidates[:1] for part in candidate.content.parts)
+
+
+def _stream_attempt(model_name: str, prompt: str, api_key: str, events: queue.Queue,
+                    cancelled: threading.Event) -> None:
+    """Stream one model on a worker thread, reporting (model, kind, value) to events.
+    
+    kind is "chunk" for each piece of text, then "done" or "error". An
+    attempt that is cancelled stops quietly and records nothing.
+    """
+    start = time.perf_counter()
+    started = False
+    try:
+        with backend_limits["llm"]:
+            for text in stream_model_text(model_name, prompt, api_key):
+                if cancelled.is_set():
+                    return
+                if not text:
+                    continue
+                if not started:
+                    # Time to first chunk is what the reader waits for
+                    started = True
+                    model_router.record_success(model_name, time.perf_counter() - start)
+                events.put((model_name, "chunk", text))
+    except Exception as e:
+        if not cancelled.is_set():
+            model_router.record_failure(model_name, time.perf_counter() - start)
+        events.put((model_name, "error", e))
+        return
+    if not started:
+        if not cancelled.is_set():
+            model_router.record_failure(model_name, time.perf_counter() - start)
+        events.put((model_name, "error", RuntimeError(f"{model_name} returned an empty response")))
+        return
+    events.put((model_name, "done", None))
+
+
+class ModelStream:
+    """Iterator over streamed text chunks; .model names the model once text arrives."""
+    
+    def __init__(self):
+        self.model = None
+        self._chunks = iter(())
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self._chunks)
+    
+    def close(self) -> None:
+        close = getattr(self._chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def stream_gemini(prompt: str, api_key: str, hedge_after: float = MODEL_HEDGE_AFTER) -> ModelStream:
+    """Stream response text chunks from the fastest healthy streaming model.
+    
+    Models are tried in the router's order, skipping those whose breaker
+    refuses the call. If no text has arrived hedge_after seconds after the
+    last model was started, the next model is started as well and the
+    first to produce text wins; the others are cancelled. A model that
+    fails or returns nothing before its first chunk is replaced by the
+    next one. Once text has been yielded, errors are raised to the caller.
+    """
+    stream = ModelStream()
+    stream._chunks = _hedged_chunks(prompt, api_key, hedge_after, stream)
+    return stream
+
+
+def _hedged_chunks(prompt: str, api_key: str, hedge_after: float, stream: ModelStream):
+    events = queue.Queue()
+    attempts = {}  # model -> (cancel event, start time) for every model started
+    active = set()  # started models that have not failed
+    candidates = iter(model_router.ranked())
+    
+    def start_next() -> bool:
+        for model_name in candidates:
+            if model_router.breakers[model_name].allow():
+                cancelled = threading.Event()
+                attempts[model_name] = (cancelled, time.perf_counter())
+                active.add(model_name)
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(_stream_attempt, model_name, prompt, api_key, events, cancelled),
+                    name=f"stream-{model_name}",
+                    daemon=True,
+                ).start()
+                return True
+        return False
+    
+    if not start_next():
+        raise RuntimeError("No streaming model is currently available")
+    winner = None
+    try:
+        while True:
+            try:
+                model_name, kind, value = events.get(timeout=hedge_after if winner is None else None)
+            except queue.Empty:
+                # First chunk overdue: race the next model against the slow one
+                start_next()
+                continue
+            if winner is None:
+                if kind != "chunk":
+                    active.discard(model_name)
+                    if not active and not start_next():
+                        raise value
+                    continue
+                winner = stream.model = model_name
+                for other in active - {winner}:
+                    # The loser was at least this slow; count it towards its latency
+                    cancelled, started_at = attempts[other]
+                    cancelled.set()
+                    model_router.record_latency(other, time.perf_counter() - started_at)
+            if model_name != winner:
+                continue
+            if kind == "chunk":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        for cancelled, _ in attempts.values():
+            cancelled.set()
+
+
+def ask_gemini_streaming(prompt: str, api_key: str, stream=stream_gemini, cache: ResponseCache = None,
+                         ask=ask_gemini_serialized):
+    """Yield the answer to prompt in chunks as they arrive.
+    
+    Cached answers are yielded whole. If streaming fails before any text
+    arrives, falls back to the blocking ask() model chain. Answers are
+    cached with the model that produced them.
+    """
+    response = cache.get(prompt) if cache is not None else None
+    if response is not None:
+        yield response
+        return
+    
+    parts = []
+    try:
+        with span("ask_gemini_stream"):
+            chunks = stream(prompt, api_key)
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        model = getattr(chunks, "model", None)
+    except Exception:
+        if parts:
+            raise
+        with span("ask_gemini"), backend_limits["llm"]:
+            parts = [ask(prompt, api_key)]
+        model = BLOCKING_MODEL
+        yield parts[0]
+    if cache is not None:
+        cache.put(prompt, "".join(parts), model=model, ttl=response_ttl(model))
+
+
+def iter_json_objects(chunks):
+    """Yield the raw text of each outermost JSON object in a text stream.
+    
+    Objects are yielded as soon as their closing brace arrives, so callers
+    can act on the first scene while later ones are still being generated.
+    Text around the objects (array brackets, code fences) is ignored.
+    """
+    text = ""
+    pos = 0
+    depth = 0
+    start = None
+    in_string = False
+    escape = False
+    for chunk in chunks:
+        text += chunk
+        while pos < len(text):
+            ch = text[pos]
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == "\\":
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = start is not None
+            elif ch == "{":
+                if start is None:
+                    start = pos
+                depth += 1
+            elif ch == "}" and start is not None:
+                depth -= 1
+                if depth == 0:
+                    yield text[start:pos + 1]
+                    start = None
+            pos += 1
+
+
+def parse_scene(raw: str):
+    """Return (visual description, subtitle) from a scene object, or None if malformed."""
+    try:
+        scene = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(scene, dict):
+        return None
+    visual_desc = scene.get("visual")
+    subtitle = scene.get("subtitle")
+    if not isinstance(visual_desc, str) or not isinstance(subtitle, str):
+        return None
+    if not visual_desc.strip() or not subtitle.strip():
+        return None
+    return visual_desc.strip(), subtitle.strip()
+
+
+def repair_scene(prompt: str, scenes: list, number: int, api_key: str, cache: ResponseCache = None,
+                 ask=ask_gemini_serialized):
+    """Ask the model to regenerate a single malformed or missing scene."""
+    planned = "\n".join(
+        json.dumps({"visual": visual_desc, "subtitle": subtitle}, ensure_ascii=False)
+        for visual_desc, subtitle in scenes
+    ) or "(none)"
+    repair_prompt = prompt + SCENE_REPAIR_INSTRUCTIONS.format(scenes=planned, number=number)
+    try:
+        response = ask_gemini_cached(repair_prompt, api_key, cache=cache, ask=ask)
+    except Exception:
+        return None
+    for raw in iter_json_objects([response]):
+        return parse_scene(raw)
+    return None
+
+
+def plan_scenes(query: str, results, api_key: str, count: int = SCENE_COUNT, stream=stream_gemini,
+                stats: dict = None, cache: ResponseCache = None, ask=ask_gemini_serialized):
+    """Yield (visual description, subtitle) pairs as the model completes each scene.
+    
+    The model is asked for a JSON array of scenes, which is parsed
+    incrementally from the stream. A malformed or missing scene is
+    re-requested on its own rather than regenerating the whole plan. If no
+    structured output arrives at all, falls back to the free-text plan and
+    parse_sequential_image_descriptions().
+    """
+    stats = stats if stats is not None else {"plans": 0, "structured": 0, "repaired": 0, "fallbacks": 0}
+    stats["plans"] += 1
+    story_prompt = build_sequential_story_images_prompt(query, results)
+    prompt = story_prompt + SCENE_JSON_INSTRUCTIONS.format(count=count)
+    
+    cached = cache.get(prompt) if cache is not None else None
+    received = []
+    streamed = None
+    
+    def chunks():
+        nonlocal streamed
+        with span("ask_gemini_stream"):
+            if cached is None:
+                streamed = stream(prompt, api_key)
+            for chunk in ([cached] if cached is not None else streamed):
+                received.append(chunk)
+                yield chunk
+    
+    scenes = []
+    repaired = False
+    objects = 0
+    try:
+        for raw in iter_json_objects(chunks()):
+            if len(scenes) >= count:
+                break
+            objects += 1
+            scene = parse_scene(raw)
+            if scene is None:
+                repaired = True
+                scene = repair_scene(story_prompt, scenes, len(scenes) + 1, api_key, cache=cache, ask=ask)
+                if scene is None:
+                    continue
+            scenes.append(scene)
+            yield scene
+    except Exception:
+        # Keep whatever scenes arrived; the rest are repaired below
+        repaired = True
+    
+    if not objects:
+        # No structured output at all - use the free-text plan instead
+        stats["fallbacks"] += 1
+        descriptions_response = ask_gemini_cached(story_prompt, api_key, cache=cache, ask=ask)
+        yield from parse_sequential_image_descriptions(descriptions_response)
+        return
+    
+    while len(scenes) < count:
+        repaired = True
+        scene = repair_scene(story_prompt, scenes, len(scenes) + 1, api_key, cache=cache, ask=ask)
+        if scene is None:
+            break
+        scenes.append(scene)
+        yield scene
+    
+    if repaired:
+        stats["repaired"] += 1
+    else:
+        stats["structured"] += 1
+        if cached is None and cache is not None:
+            model = getattr(streamed, "model", None)
+            cache.put(prompt, "".join(received), model=model, ttl=response_ttl(model))
+
+
+def trim_cache_dir(directory: Path, pattern: str, max_bytes: int) -> list:
+    """Delete least recently used files matching pattern until under max_bytes.
+    
+    Returns the stems of the deleted files.
+    """
+    files = sorted(directory.glob(pattern), key=lambda f: f.stat().st_mtime)
+    total = sum(f.stat().st_size for f in files)
+    evicted = []
+    while files and total > max_bytes:
+        oldest = files.pop(0)
+        total -= oldest.stat().st_size
+        oldest.unlink()
+        evicted.append(oldest.stem)
+    return evicted
+
+
+class ImageCache:
+    """Content-addressed cache of generated images.
+    
+    Images are stored as JPEG files named by a hash of the generation
+    parameters, with an in-memory LRU of decoded PIL images in front. The
+    directory is trimmed to max_bytes by evicting least recently used files.
+    """
+    
+    def __init__(self, directory: Path, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 memory_size: int = IMAGE_CACHE_MEMORY_SIZE):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(prompt: str, method: str = "pollinations") -> str:
+        """Return the cache key for a prompt and generation method."""
+        return hashlib.sha256(f"{method}\n{prompt}".encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        """Return the cached image for key, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            
+            path = self.directory / f"{key}.jpg"
+            image = None
+            if path.exists():
+                try:
+                    image = Image.open(path)
+                    image.load()
+                    os.utime(path)  # Mark as recently used for eviction
+                except Exception:
+                    image = None
+            
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, image)
+            return image
+    
+    def put(self, key: str, image) -> None:
+        """Store an image in memory and on disk."""
+        with self._lock:
+            self._remember(key, image)
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                path = self.directory / f"{key}.jpg"
+                tmp_path = path.with_suffix(".tmp")
+                image.convert("RGB").save(tmp_path, format="JPEG", quality=90)
+                tmp_path.replace(path)
+                self._evict()
+            except Exception:
+                # Disk caching is best-effort
+                pass
+    
+    def _remember(self, key: str, image) -> None:
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+    
+    def _evict(self) -> None:
+        for key in trim_cache_dir(self.directory, "*.jpg", self.max_bytes):
+            self._memory.pop(key, None)
+            self.evictions += 1
+
+
+class CircuitBreaker:
+    """Fail fast after repeated service failures until a cooldown elapses.
+    
+    Closed: every call is allowed. Open: calls fail fast until
+    reset_timeout has passed. Half-open: a single probe call is let
+    through and everyone else keeps failing fast until its result is
+    recorded; success closes the breaker, failure opens it again. A probe
+    that never reports back is replaced after another reset_timeout.
+    
+    Also keeps the latencies of recent calls for the diagnostics display.
+    """
+    
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latencies = deque(maxlen=100)
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started = None
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self) -> bool:
+        return self.state != "closed"
+    
+    def allow(self) -> bool:
+        """Return True if a call may be attempted."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+            elif now - self._probe_started < self.reset_timeout:
+                # Half-open with a probe still in flight
+                return False
+            self._probe_started = now
+            return True
+    
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            self._failures = 0
+            self.state = "closed"
+            self._opened_at = None
+    
+    def record_failure(self, latency: float) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class ModelRouter:
+    """Per-model health and latency for streamed answers.
+    
+    Each model has a CircuitBreaker that skips it after consecutive hard
+    failures, plus a window of recent calls (time to first chunk, success).
+    ranked() keeps the preference order but moves models whose p95 time to
+    first chunk or error rate is too high behind the others. Samples older
+    than stats_window expire, so a demoted model returns to its place once
+    its bad calls age out.
+    """
+    
+    def __init__(self, models=STREAM_MODELS, failure_threshold: int = MODEL_FAILURE_THRESHOLD,
+                 reset_timeout: float = MODEL_RESET_TIMEOUT, stats_window: float = MODEL_STATS_WINDOW,
+                 min_samples: int = MODEL_MIN_SAMPLES, slow_p95: float = MODEL_SLOW_P95,
+                 max_error_rate: float = MODEL_MAX_ERROR_RATE):
+        self.models = tuple(models)
+        self.breakers = {model: CircuitBreaker(failure_threshold, reset_timeout) for model in self.models}
+        self.stats_window = stats_window
+        self.min_samples = min_samples
+        self.slow_p95 = slow_p95
+        self.max_error_rate = max_error_rate
+        self._samples = {model: deque(maxlen=200) for model in self.models}  # (time, latency, ok)
+        self._lock = threading.Lock()
+    
+    def record_success(self, model: str, latency: float) -> None:
+        self.breakers[model].record_success(latency)
+        self.record_latency(model, latency)
+    
+    def record_failure(self, model: str, latency: float) -> None:
+        self.breakers[model].record_failure(latency)
+        with self._lock:
+            self._samples[model].append((time.monotonic(), latency, False))
+    
+    def record_latency(self, model: str, latency: float) -> None:
+        """Record a call that did not fail, without touching the breaker."""
+        with self._lock:
+            self._samples[model].append((time.monotonic(), latency, True))
+    
+    def stats(self, model: str) -> dict:
+        """Return p50/p95 time to first chunk, error rate and sample count over the window."""
+        cutoff = time.monotonic() - self.stats_window
+        with self._lock:
+            samples = self._samples[model]
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            latencies = sorted(latency for _, latency, ok in samples if ok)
+            errors = sum(1 for _, _, ok in samples if not ok)
+            count = len(samples)
+        return {
+            "samples": count,
+            "p50": latencies[len(latencies) // 2] if latencies else None,
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            "error_rate": errors / count if count else 0.0,
+        }
+    
+    def degraded(self, model: str) -> bool:
+        """Return True if the model has recently been too slow or too error-prone."""
+        stats = self.stats(model)
+        if stats["samples"] < self.min_samples:
+            return False
+        return stats["error_rate"] > self.max_error_rate or (stats["p95"] or 0.0) > self.slow_p95
+    
+    def ranked(self) -> list:
+        """Return the models to try, healthy ones first, each group in preference order."""
+        degraded = {model for model in self.models if self.degraded(model)}
+        return [model for model in self.models if model not in degraded] + \
+               [model for model in self.models if model in degraded]
+    
+    def p50(self, model: str):
+        return self.stats(model)["p50"]
+
+
+# Process-wide health tracking for the streaming models
+model_router = ModelRouter()
+
+
+def build_comic_prompt(visual_desc: str) -> str:
+    """Enhance a scene description with the comic illustration style."""
+    # Subtitle is displayed in the UI, not in the image
+    return f"{visual_desc}, Indian comic book illustration style, vibrant colors, expressive characters, child-friendly, educational storytelling art, visual narrative that tells a story, detailed scene"
+
+
+def generate_scene_image(prompt: str, retries: int = SCENE_RETRIES, cache: ImageCache = None,
+                         breaker: CircuitBreaker = None, generate=generate_image_from_prompt):
+    """Generate one scene image, retrying failed or empty responses.
+    
+    Retries back off exponentially with jitter. While the breaker is open
+    the call fails immediately instead of waiting on a dead service.
+    """
+    key = ImageCache.key(prompt)
+    if cache is not None:
+        image = cache.get(key)
+        if image is not None:
+            return image
+    
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, SCENE_BACKOFF * 2 ** (attempt - 1)))
+        if breaker is not None and not breaker.allow():
+            raise RuntimeError("Image service is unavailable, please try again shortly")
+        
+        start = time.perf_counter()
+        try:
+            with span("generate_image_from_prompt"), backend_limits["image"]:
+                image = generate(prompt, method="pollinations")
+        except Exception as e:
+            image = None
+            last_error = e
+        
+        if breaker is not None:
+            if image:
+                breaker.record_success(time.perf_counter() - start)
+            else:
+                breaker.record_failure(time.perf_counter() - start)
+        if image:
+            if cache is not None:
+                cache.put(key, image)
+            return image
+    if last_error:
+        raise last_error
+    return None
+
+
+def generate_scene_images(prompts, max_workers: int = SCENE_CONCURRENCY, timeout: float = SCENE_TIMEOUT,
+                          cache: ImageCache = None, breaker: CircuitBreaker = None,
+                          generate=generate_image_from_prompt):
+    """Generate scene images concurrently.
+    
+    Yields (scene_number, image, error) tuples in completion order, so the
+    caller can display each scene as soon as it is ready. prompts may be a
+    generator; requests are submitted as each prompt is produced. Each
+    scene gets timeout seconds from its own submission; a scene that runs
+    over is reported with a TimeoutError while the others carry on.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    scene_numbers = {}
+    deadlines = {}
+    # prompts may be a lazy stream; each scene starts as soon as it arrives
+    for i, prompt in enumerate(prompts, 1):
+        future = executor.submit(contextvars.copy_context().run, generate_scene_image, prompt, SCENE_RETRIES,
+                                 cache, breaker, generate)
+        scene_numbers[future] = i
+        deadlines[future] = time.monotonic() + timeout
+    pending = set(scene_numbers)
+    try:
+        while pending:
+            next_deadline = min(deadlines[future] for future in pending)
+            done, _ = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in sorted(pending, key=scene_numbers.get):
+                if future in done:
+                    pending.discard(future)
+                    try:
+                        yield scene_numbers[future], future.result(), None
+                    except Exception as e:
+                        yield scene_numbers[future], None, e
+                elif deadlines[future] <= now:
+                    pending.discard(future)
+                    future.cancel()
+                    yield scene_numbers[future], None, TimeoutError(f"timed out after {timeout:g}s")
+    finally:
+        # Don't block the rerun on stragglers
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def prepare_for_caption(image, max_side: int = CAPTION_MAX_SIDE):
+    """Downscale and re-encode an image as JPEG before upload.
+    
+    Returns (image, encoded size in bytes).
+    """
+    image = image.convert("RGB")
+    image.thumbnail((max_side, max_side))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=CAPTION_JPEG_QUALITY, optimize=True)
+    size = buffer.tell()
+    buffer.seek(0)
+    return Image.open(buffer), size
+
+
+def dhash(image, hash_size: int = 8) -> int:
+    """Return the difference hash of an image as an int of hash_size**2 bits."""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = gray.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def color_signature(image, size: int = 4) -> bytes:
+    """Return the coarse colour layout of an image (size x size RGB block averages)."""
+    return image.convert("RGB").resize((size, size), Image.BOX).tobytes()
+
+
+class CaptionCache:
+    """LRU of image captions keyed by perceptual hash.
+    
+    Lookups also match near-duplicates whose hash differs in at most
+    max_distance bits, so re-uploads and re-encodes hit the cache. The
+    grayscale hash alone collides for images with the same brightness
+    pattern (every flat image hashes to 0), so a match must also agree on
+    the coarse colour layout and the aspect ratio.
+    """
+    
+    def __init__(self, max_entries: int = CAPTION_CACHE_SIZE, max_distance: int = CAPTION_HASH_DISTANCE,
+                 color_tolerance: int = CAPTION_COLOR_TOLERANCE, aspect_tolerance: float = CAPTION_ASPECT_TOLERANCE):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.color_tolerance = color_tolerance
+        self.aspect_tolerance = aspect_tolerance
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _matches(self, key: tuple, image_hash: int, signature: bytes, aspect: float) -> bool:
+        other_hash, other_signature, other_aspect = key
+        return (
+            bin(other_hash ^ image_hash).count("1") <= self.max_distance
+            and abs(other_aspect - aspect) <= self.aspect_tolerance * max(other_aspect, aspect)
+            and len(other_signature) == len(signature)
+            and max(abs(a - b) for a, b in zip(other_signature, signature)) <= self.color_tolerance
+        )
+    
+    def get(self, image_hash: int, signature: bytes, aspect: float):
+        """Return the caption for an identical or near-identical image, or None."""
+        with self._lock:
+            key = (image_hash, signature, aspect)
+            match = key if key in self._entries else None
+            if match is None:
+                for other in self._entries:
+                    if self._matches(other, image_hash, signature, aspect):
+                        match = other
+                        break
+            if match is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(match)
+            self.hits += 1
+            return self._entries[match]
+    
+    def put(self, image_hash: int, signature: bytes, aspect: float, caption: str) -> None:
+        with self._lock:
+            key = (image_hash, signature, aspect)
+            self._entries[key] = caption
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def caption_image_cached(image, api_key: str, original_bytes: int, cache: CaptionCache = None,
+                         captioner=caption_image_serialized) -> str:
+    """Caption an image, reusing captions of visually identical images.
+    
+    On a miss the image is downscaled and re-encoded before upload.
+    original_bytes is the uploaded file size, used for the bytes-saved metric.
+    """
+    with span("image_fingerprint"):
+        image_hash = dhash(image)
+        signature = color_signature(image)
+        aspect = image.width / image.height
+    if cache is not None:
+        caption = cache.get(image_hash, signature, aspect)
+        if caption is not None:
+            cache.bytes_saved += original_bytes
+            return caption
+    
+    with span("prepare_for_caption"):
+        prepared, size = prepare_for_caption(image)
+    with span("caption_image"), backend_limits["llm"]:
+        caption = captioner(prepared, api_key)
+    if cache is not None:
+        cache.bytes_saved += max(0, original_bytes - size)
+        cache.put(image_hash, signature, aspect, caption)
+    return caption
+
+
+class AudioCache:
+    """Disk cache of synthesized MP3 audio, keyed by the narrated text."""
+    
+    def __init__(self, directory: Path, max_bytes: int = AUDIO_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(text: str) -> str:
+        """Return the cache key for a chunk of text."""
+        # Language is auto-detected from the text, so the text alone is the key
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        """Return cached MP3 bytes for key, or None."""
+        path = self.directory / f"{key}.mp3"
+        with self._lock:
+            try:
+                data = path.read_bytes()
+                os.utime(path)  # Mark as recently used for eviction
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+    
+    def put(self, key: str, data: bytes) -> None:
+        """Store MP3 bytes on disk, evicting old entries over the size cap."""
+        with self._lock:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                path = self.directory / f"{key}.mp3"
+                tmp_path = path.with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                tmp_path.replace(path)
+                trim_cache_dir(self.directory, "*.mp3", self.max_bytes)
+            except Exception:
+                # Disk caching is best-effort
+                pass
+
+
+def split_sentences(text: str) -> list:
+    """Split text into sentences on ., !, ? and the Devanagari danda."""
+    sentences = re.split(r"(?<=[.!?।॥])\s+", text.strip())
+    return [sentence for sentence in sentences if sentence.strip()]
+
+
+def synthesize_chunk(text: str, cache: AudioCache = None, synthesize=generate_speech):
+    """Return MP3 bytes for one chunk of text, using the cache when possible."""
+    key = AudioCache.key(text)
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+    
+    with span("generate_speech"), backend_limits["tts"]:
+        audio = synthesize(text)
+    if not audio:
+        return None
+    data = audio.getvalue() if hasattr(audio, "getvalue") else bytes(audio)
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+
+def synthesize_chunks(text: str, cache: AudioCache = None, synthesize=generate_speech,
+                      max_workers: int = TTS_CONCURRENCY):
+    """Synthesize text sentence by sentence in parallel.
+    
+    Yields MP3 bytes per sentence in order, so playback of the first
+    sentence can start before the rest are done. Failed sentences are skipped.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(contextvars.copy_context().run, synthesize_chunk, sentence, cache, synthesize) for sentence in sentences]
+        for future in futures:
+            try:
+                data = future.result()
+            except Exception:
+                data = None
+            if data:
+                yield data
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SentenceNarrator:
+    """Synthesize streamed text sentence by sentence as it completes.
+    
+    feed() is called with the text received so far; every sentence that is
+    known to be complete is handed to the TTS pool straight away, so audio
+    for the opening sentences is ready by the time the text finishes.
+    """
+    
+    def __init__(self, cache: AudioCache = None, synthesize=generate_speech,
+                 max_workers: int = TTS_CONCURRENCY):
+        self.cache = cache
+        self.synthesize = synthesize
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+    
+    def feed(self, text: str) -> None:
+        """Submit newly completed sentences (the last fragment may be partial)."""
+        self._submit(split_sentences(text)[:-1])
+    
+    def finish(self, text: str):
+        """Submit the remaining text and return the joined MP3, or None."""
+        self._submit(split_sentences(text))
+        parts = []
+        try:
+            for future in self._futures:
+                try:
+                    data = future.result()
+                except Exception:
+                    data = None
+                if data:
+                    parts.append(data)
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        return b"".join(parts) or None
+    
+    def _submit(self, sentences: list) -> None:
+        for sentence in sentences[len(self._futures):]:
+            self._futures.append(
+                self._executor.submit(
+                    contextvars.copy_context().run, synthesize_chunk, sentence, self.cache, self.synthesize
+                )
+            )
+
+
+def narrate(text: str, cache: AudioCache = None, synthesize=generate_speech):
+    """Return MP3 narration for text, or None if synthesis failed."""
+    # MP3 frames are self-delimiting, so per-sentence audio concatenates cleanly
+    audio = b"".join(synthesize_chunks(text, cache=cache, synthesize=synthesize))
+    return audio or None
+
+
+def search_verses(query: str, top_k: int, index: FieldBM25Index, cache: QueryCache):
+    """Retrieve verses for query, reusing results of repeated queries."""
+    key = (normalize_query(query), top_k)
+    results = cache.get(key)
+    if results is None:
+        with span("retrieve_verses"):
+            results = hybrid_retrieve(query, index, top_k=top_k)
+        cache.put(key, results)
+    return results
+
+
+def credential_fingerprint(api_key: str) -> str:
+    """Return a short, non-reversible id for an API key, for use in job keys."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class Job:
+    """One background generation, polled by the UI via its id."""
+    
+    def __init__(self, user: str, key: tuple, fn, args: tuple):
+        self.id = uuid.uuid4().hex[:12]
+        self.user = user
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.status = "queued"  # queued -> running -> done | error
+        self.progress = {}  # partial results, written by fn while it runs
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        # Run under the submitter's context so spans join its trace
+        self.context = contextvars.copy_context()
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+
+class JobScheduler:
+    """Runs long generations on background threads, outside Streamlit reruns.
+    
+    Each user's jobs run one at a time in submission order. A job whose key
+    matches one that is still queued or running is not started again; the
+    caller gets the existing job instead. Jobs that call a paid backend
+    should include credential_fingerprint(api_key) in the key, so a job is
+    only shared between callers using the same key. Finished jobs are kept for
+    `retention` seconds so a rerun or a page refresh can pick up the result
+    by job id.
+    """
+    
+    def __init__(self, max_workers: int = JOB_WORKERS, max_queued: int = JOB_MAX_QUEUED,
+                 retention: float = JOB_RETENTION):
+        self.max_queued = max_queued
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}  # id -> Job
+        self._in_flight = {}  # key -> queued or running Job
+        self._queues = {}  # user -> deque of queued Jobs
+        self._running = set()  # users with a running job
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+    
+    def submit(self, user: str, key: tuple, fn, *args) -> Job:
+        """Queue fn(job.progress, *args) for user and return its Job.
+        
+        Raises RuntimeError if the user already has too many jobs queued.
+        """
+        with self._lock:
+            self._expire()
+            job = self._in_flight.get(key)
+            if job is not None:
+                self.deduplicated += 1
+                return job
+            queue = self._queues.setdefault(user, deque())
+            if len(queue) >= self.max_queued:
+                self.rejected += 1
+                raise RuntimeError("Too many requests queued, please wait for the current one to finish")
+            job = Job(user, key, fn, args)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+            queue.append(job)
+            self.submitted += 1
+            self._dispatch(user)
+        return job
+    
+    def get(self, job_id: str):
+        """Return the job with job_id, or None if unknown or expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def position(self, job: Job) -> int:
+        """Return how many of the user's jobs are ahead of job (0 once running)."""
+        with self._lock:
+            queue = self._queues.get(job.user, ())
+            return list(queue).index(job) + 1 if job in queue else 0
+    
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "error")}
+    
+    def _dispatch(self, user: str) -> None:
+        # Caller holds the lock
+        if user in self._running:
+            return
+        queue = self._queues.get(user)
+        if not queue:
+            self._queues.pop(user, None)
+            return
+        job = queue.popleft()
+        job.status = "running"
+        self._running.add(user)
+        self._executor.submit(job.context.run, self._run, job)
+    
+    def _run(self, job: Job) -> None:
+        try:
+            job.result = job.fn(job.progress, *job.args)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.monotonic()
+            with self._lock:
+                if self._in_flight.get(job.key) is job:
+                    del self._in_flight[job.key]
+                self._running.discard(job.user)
+                self._dispatch(job.user)
+    
+    def _expire(self) -> None:
+        # Caller holds the lock
+        cutoff = time.monotonic() - self.retention
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+def story_job(progress: dict, query: str, results, api_key: str, response_cache: ResponseCache,
+              image_cache: ImageCache, breaker: CircuitBreaker, audio_cache: AudioCache, plan_stats: dict,
+              stream=stream_gemini, ask=ask_gemini_serialized, generate=generate_image_from_prompt,
+              synthesize=generate_speech):
+    """Plan, illustrate and narrate a visual story, publishing scenes as they complete.
+    
+    progress["scenes"] holds one dict per planned scene (visual, subtitle,
+    image, error); returns {"scenes": the same list, "audio": MP3 bytes or None}.
+    """
+    scenes = progress["scenes"] = []
+    progress["done"] = 0
+    progress["status"] = "✍️ Planning scenes..."
+    
+    def scene_prompts():
+        plan = plan_scenes(query, results, api_key, stream=stream, stats=plan_stats, cache=response_cache, ask=ask)
+        for visual_desc, subtitle in plan:
+            scenes.append({"visual": visual_desc, "subtitle": subtitle, "image": None, "error": None})
+            progress["status"] = f"🎨 Creating Scene {len(scenes)}..."
+            yield build_comic_prompt(visual_desc)
+    
+    # Images start as soon as each scene is planned
+    for done, (i, image, error) in enumerate(
+        generate_scene_images(scene_prompts(), cache=image_cache, breaker=breaker, generate=generate), 1
+    ):
+        scenes[i - 1]["image"] = image
+        scenes[i - 1]["error"] = None if image else str(error or "no image returned")
+        progress["done"] = done
+        progress["status"] = f"🎨 Created Scene {i} ({done}/{len(scenes)})..."
+    
+    generated_story = [scene for scene in scenes if scene["image"]]
+    if not generated_story:
+        return {"scenes": scenes, "audio": None}
+    
+    progress["status"] = "🔊 Recording narration..."
+    narration_parts = [f"Scene {i}: {scene['subtitle']}" for i, scene in enumerate(scenes, 1) if scene["image"]]
+    full_narration = ". ".join(narration_parts) + "."
+    return {"scenes": scenes, "audio": narrate(full_narration, cache=audio_cache, synthesize=synthesize)}
+
+
+def analyze_image_job(progress: dict, image, original_bytes: int, api_key: str, search, packer: ContextPacker,
+                      caption_cache: CaptionCache, response_cache: ResponseCache, audio_cache: AudioCache,
+                      captioner=caption_image_serialized, ask=ask_gemini_serialized,
+                      synthesize=generate_speech):
+    """Caption an image, retrieve matching verses and explain the scene.
+    
+    search(query, top_k) retrieves verses. Returns {"explanation", "audio"},
+    with explanation None when no verses matched.
+    """
+    progress["status"] = "🔍 Describing the image..."
+    image_caption = caption_image_cached(image, api_key, original_bytes=original_bytes, cache=caption_cache,
+                                         captioner=captioner)
+    results = search(image_caption, 5)
+    if not results:
+        return {"explanation": None, "audio": None}
+    
+    progress["status"] = "📖 Writing the story..."
+    prompt = build_image_to_text_prompt(image_caption, packer.pack(results, IMAGE_CONTEXT_FIELDS))
+    explanation = ask_gemini_cached(prompt, api_key, cache=response_cache, ask=ask)
+    progress["status"] = "🔊 Recording narration..."
+    return {"explanation": explanation, "audio": narrate(explanation, cache=audio_cache, synthesize=synthesize)}
@@ -0,0 +1,67 @@
+"""CaptionCache matching: near-duplicates hit, flat images of different colours do not."""
+import io
+
+from PIL import Image, ImageDraw
+
+from pipeline import CaptionCache, caption_image_cached, dhash
+
+
+def counting_captioner():
+    calls = []
+    
+    def captioner(image, api_key):
+        calls.append(image.size)
+        return f"caption {len(calls)}"
+    return captioner, calls
+
+
+def scene(size=(320, 240)):
+    image = Image.new("RGB", size, (40, 90, 160))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 30, 140, 200), fill=(220, 180, 40))
+    draw.ellipse((180, 60, 300, 180), fill=(30, 140, 60))
+    return image
+
+
+def test_flat_colours_do_not_collide():
+    red = Image.new("RGB", (200, 200), (200, 30, 30))
+    blue = Image.new("RGB", (200, 200), (30, 30, 200))
+    # The grayscale hash alone cannot tell them apart
+    assert dhash(red) == dhash(blue) == 0
+    cache = CaptionCache()
+    captioner, calls = counting_captioner()
+    assert caption_image_cached(red, "key", 1000, cache, captioner) == "caption 1"
+    assert caption_image_cached(blue, "key", 1000, cache, captioner) == "caption 2"
+    assert cache.hits == 0
+
+
+def test_same_colours_different_aspect_do_not_collide():
+    cache = CaptionCache()
+    captioner, calls = counting_captioner()
+    caption_image_cached(Image.new("RGB", (200, 200), (90, 90, 90)), "key", 1000, cache, captioner)
+    caption_image_cached(Image.new("RGB", (400, 200), (90, 90, 90)), "key", 1000, cache, captioner)
+    assert len(calls) == 2
+
+
+def test_reencoded_near_duplicate_hits():
+    original = scene()
+    buffer = io.BytesIO()
+    original.resize((300, 225)).save(buffer, format="JPEG", quality=60)
+    reencoded = Image.open(io.BytesIO(buffer.getvalue()))
+    
+    cache = CaptionCache()
+    captioner, calls = counting_captioner()
+    first = caption_image_cached(original, "key", 50_000, cache, captioner)
+    assert caption_image_cached(reencoded, "key", 20_000, cache, captioner) == first
+    assert len(calls) == 1
+    assert cache.hits == 1
+    assert cache.bytes_saved >= 20_000
+
+
+def test_lru_bound():
+    cache = CaptionCache(max_entries=2)
+    entries = [((1 << 64) - 1 >> shift, bytes([100 * i]) * 48) for i, shift in enumerate((0, 16, 32))]
+    for i, (image_hash, signature) in enumerate(entries):
+        cache.put(image_hash, signature, 1.0, f"caption {i}")
+    assert cache.get(*entries[0], 1.0) is None
+    assert cache.get(*entries[2], 1.0) == "caption 2"
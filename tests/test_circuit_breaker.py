@@ -0,0 +1,73 @@
+"""CircuitBreaker state transitions and the single half-open probe."""
+import threading
+import time
+
+from pipeline import CircuitBreaker
+
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure(0.1)
+    breaker.record_failure(0.1)
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure(0.1)
+    assert breaker.allow()
+    breaker.record_failure(0.1)
+    assert breaker.is_open and not breaker.allow()
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure(0.1)
+    breaker.record_success(0.1)
+    breaker.record_failure(0.1)
+    assert breaker.state == "closed"
+
+
+def test_single_probe_when_half_open():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    results = []
+    barrier = threading.Barrier(8)
+    
+    def caller():
+        barrier.wait()
+        results.append(breaker.allow())
+    
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    assert breaker.state == "half_open"
+
+
+def test_probe_success_closes():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_probe_failure_reopens():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure(0.1)
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_lost_probe_is_replaced_after_timeout():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
@@ -0,0 +1,64 @@
+"""JobScheduler deduplication and per-user ordering."""
+import threading
+import time
+
+from pipeline import JobScheduler, credential_fingerprint
+
+
+def wait_for(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.finished
+
+
+def billed_to(progress, api_key, release):
+    release.wait(5)
+    return api_key
+
+
+def test_same_key_and_credential_share_a_job():
+    scheduler = JobScheduler(max_workers=4)
+    release = threading.Event()
+    key = ("story", "sanjeevani", 3, credential_fingerprint("key-a"))
+    first = scheduler.submit("user-a", key, billed_to, "key-a", release)
+    second = scheduler.submit("user-b", key, billed_to, "key-a", release)
+    release.set()
+    assert second is first
+    wait_for(first)
+    assert scheduler.deduplicated == 1
+
+
+def test_different_credentials_never_share_a_job():
+    scheduler = JobScheduler(max_workers=4)
+    release = threading.Event()
+    job_a = scheduler.submit("user-a", ("story", "sanjeevani", 3, credential_fingerprint("key-a")),
+                             billed_to, "key-a", release)
+    job_b = scheduler.submit("user-b", ("story", "sanjeevani", 3, credential_fingerprint("key-b")),
+                             billed_to, "key-b", release)
+    release.set()
+    assert job_b is not job_a
+    wait_for(job_a)
+    wait_for(job_b)
+    assert (job_a.result, job_b.result) == ("key-a", "key-b")
+    assert scheduler.deduplicated == 0
+
+
+def test_fingerprint_does_not_contain_the_key():
+    fingerprint = credential_fingerprint("AIza-secret-key")
+    assert "secret" not in fingerprint
+    assert fingerprint == credential_fingerprint("AIza-secret-key")
+    assert fingerprint != credential_fingerprint("AIza-other-key")
+
+
+def test_user_jobs_run_in_order():
+    scheduler = JobScheduler(max_workers=4)
+    order = []
+    
+    def record(progress, label):
+        order.append(label)
+    
+    jobs = [scheduler.submit("user-a", ("job", i), record, i) for i in range(3)]
+    for job in jobs:
+        wait_for(job)
+    assert order == [0, 1, 2]
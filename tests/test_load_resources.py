@@ -0,0 +1,44 @@
+"""load_resources() caching of the fitted index."""
+from pathlib import Path
+
+import pytest
+
+import pipeline
+from pipeline import kb_digest, load_resources
+
+KB_PATH = Path(__file__).resolve().parent.parent / "kb.json"
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "CACHE_DIR", tmp_path)
+    return tmp_path
+
+
+def test_warm_start_reuses_the_fitted_index(cache_dir, monkeypatch):
+    kb_hash = kb_digest(KB_PATH)
+    entries, index, graph, packer = load_resources(str(KB_PATH), kb_hash)
+    assert (cache_dir / f"index_{kb_hash[:16]}.pkl").exists()
+    
+    def refit(self, *args, **kwargs):
+        raise AssertionError("index was refit on a warm start")
+    
+    # Unpickling does not call __init__, so only a refit trips this
+    monkeypatch.setattr(pipeline.FieldBM25Index, "__init__", refit)
+    _, warm_index, _, _ = load_resources(str(KB_PATH), kb_hash)
+    assert [entry.id for entry in warm_index.entries] == [entry.id for entry in entries]
+
+
+def test_stale_pickles_are_deleted(cache_dir):
+    (cache_dir / "index_0000000000000000.pkl").write_bytes(b"old")
+    (cache_dir / "embeddings_0000000000000000.pkl").write_bytes(b"old")
+    kb_hash = kb_digest(KB_PATH)
+    load_resources(str(KB_PATH), kb_hash)
+    assert sorted(path.name for path in cache_dir.glob("*.pkl")) == [f"index_{kb_hash[:16]}.pkl"]
+
+
+def test_corrupt_pickle_is_rebuilt(cache_dir):
+    kb_hash = kb_digest(KB_PATH)
+    (cache_dir / f"index_{kb_hash[:16]}.pkl").write_bytes(b"not a pickle")
+    _, index, _, _ = load_resources(str(KB_PATH), kb_hash)
+    assert index.entries
@@ -0,0 +1,105 @@
+"""Routing and hedging of streamed answers, with scripted model latencies."""
+import math
+import time
+
+import pytest
+
+import pipeline
+from pipeline import BackendLimiter, ModelRouter
+
+
+def scripted_models(monkeypatch, script):
+    """Replace the Gemini stream with per-model (first chunk delay, chunks or exception)."""
+    calls = []
+    
+    def fake_stream(model_name, prompt, api_key):
+        calls.append(model_name)
+        delay, result = script[model_name]
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        yield from result
+    
+    monkeypatch.setattr(pipeline, "stream_model_text", fake_stream)
+    return calls
+
+
+@pytest.fixture
+def router(monkeypatch):
+    router = ModelRouter(("primary", "secondary", "tertiary"), min_samples=3, slow_p95=1.0)
+    monkeypatch.setattr(pipeline, "model_router", router)
+    monkeypatch.setitem(pipeline.backend_limits, "llm", BackendLimiter(8, math.inf))
+    return router
+
+
+def test_stream_models_include_pro():
+    assert "gemini-2.5-pro" in pipeline.STREAM_MODELS
+
+
+def test_fast_primary_is_used_alone(monkeypatch, router):
+    calls = scripted_models(monkeypatch, {"primary": (0.0, ["a", "b"]), "secondary": (0.0, ["x"]),
+                                          "tertiary": (0.0, ["y"])})
+    assert "".join(pipeline.stream_gemini("q", "key", hedge_after=0.5)) == "ab"
+    assert calls == ["primary"]
+
+
+def test_hedge_beats_slow_primary(monkeypatch, router):
+    calls = scripted_models(monkeypatch, {"primary": (1.0, ["slow"]), "secondary": (0.0, ["fast"]),
+                                          "tertiary": (0.0, ["y"])})
+    start = time.perf_counter()
+    assert "".join(pipeline.stream_gemini("q", "key", hedge_after=0.1)) == "fast"
+    assert time.perf_counter() - start < 0.8
+    assert calls == ["primary", "secondary"]
+    # The cancelled primary is charged at least the time it kept the reader waiting
+    assert router.stats("primary")["samples"] == 1
+    assert router.stats("primary")["p50"] >= 0.1
+
+
+def test_failure_before_first_chunk_falls_through(monkeypatch, router):
+    calls = scripted_models(monkeypatch, {"primary": (0.0, RuntimeError("quota")),
+                                          "secondary": (0.0, ["ok"]), "tertiary": (0.0, ["y"])})
+    assert "".join(pipeline.stream_gemini("q", "key", hedge_after=0.5)) == "ok"
+    assert calls == ["primary", "secondary"]
+    assert router.stats("primary")["error_rate"] == 1.0
+
+
+def test_open_breaker_skips_model(monkeypatch, router):
+    calls = scripted_models(monkeypatch, {"primary": (0.0, RuntimeError("down")),
+                                          "secondary": (0.0, ["ok"]), "tertiary": (0.0, ["y"])})
+    for _ in range(router.breakers["primary"].failure_threshold):
+        "".join(pipeline.stream_gemini("q", "key", hedge_after=0.5))
+    calls.clear()
+    assert "".join(pipeline.stream_gemini("q", "key", hedge_after=0.5)) == "ok"
+    assert calls == ["secondary"]
+
+
+def test_all_models_failing_raises(monkeypatch, router):
+    scripted_models(monkeypatch, {name: (0.0, RuntimeError(name)) for name in router.models})
+    with pytest.raises(RuntimeError):
+        "".join(pipeline.stream_gemini("q", "key", hedge_after=0.5))
+
+
+def test_slow_primary_is_demoted_then_restored(router):
+    for _ in range(3):
+        router.record_success("primary", 2.0)
+        router.record_success("secondary", 0.2)
+    assert router.degraded("primary")
+    assert router.ranked() == ["secondary", "tertiary", "primary"]
+    router.stats_window = 0.0
+    time.sleep(0.01)
+    assert router.ranked() == ["primary", "secondary", "tertiary"]
+
+
+def test_error_prone_model_is_demoted(router):
+    for _ in range(2):
+        router.record_failure("secondary", 0.1)
+        router.record_success("secondary", 0.1)
+    router.record_failure("secondary", 0.1)
+    assert router.stats("secondary")["error_rate"] == pytest.approx(0.6)
+    assert router.ranked() == ["primary", "tertiary", "secondary"]
+
+
+def test_few_samples_do_not_demote(router):
+    router.record_success("primary", 5.0)
+    assert not router.degraded("primary")
+    assert router.ranked()[0] == "primary"
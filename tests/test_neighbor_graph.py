@@ -0,0 +1,40 @@
+"""NeighborGraph construction and reuse."""
+import numpy as np
+from scipy import sparse
+
+from pipeline import NeighborGraph
+
+
+def vectors(n, seed=0):
+    return sparse.random(n, 30, density=0.3, format="csr", random_state=seed)
+
+
+def test_neighbors_are_most_similar_other_rows():
+    matrix = vectors(12)
+    graph = NeighborGraph.build(matrix, [f"v{i}" for i in range(12)], k=3)
+    normalized = matrix.toarray() / np.linalg.norm(matrix.toarray(), axis=1, keepdims=True)
+    similarity = normalized @ normalized.T
+    np.fill_diagonal(similarity, -np.inf)
+    for row in range(12):
+        assert row not in graph.neighbors[row]
+        np.testing.assert_allclose(graph.scores[row], np.sort(similarity[row])[::-1][:3])
+
+
+def test_unchanged_vectors_reuse_previous(tmp_path):
+    ids = [f"v{i}" for i in range(10)]
+    graph = NeighborGraph.build(vectors(10), ids, "old", k=3)
+    graph.save(tmp_path / "neighbors.npz")
+    previous = NeighborGraph.load(tmp_path / "neighbors.npz")
+    rebuilt = NeighborGraph.build(vectors(10), ids, "new", k=3, previous=previous)
+    assert rebuilt.neighbors is previous.neighbors
+    assert rebuilt.kb_hash == "new"
+
+
+def test_changed_vectors_rebuild_every_row():
+    ids = [f"v{i}" for i in range(10)]
+    previous = NeighborGraph.build(vectors(10), ids, k=3)
+    changed = vectors(12, seed=1)
+    rebuilt = NeighborGraph.build(changed, ids + ["v10", "v11"], k=3, previous=previous)
+    fresh = NeighborGraph.build(changed, ids + ["v10", "v11"], k=3)
+    np.testing.assert_array_equal(rebuilt.neighbors, fresh.neighbors)
+    np.testing.assert_allclose(rebuilt.scores, fresh.scores)
@@ -0,0 +1,83 @@
+"""ResponseCache: disk persistence, expiry and the model recorded with each answer."""
+import math
+import time
+
+import pytest
+
+import pipeline
+from pipeline import BackendLimiter, ModelStream, ResponseCache, ask_gemini_streaming
+
+
+@pytest.fixture(autouse=True)
+def unlimited_llm(monkeypatch):
+    monkeypatch.setitem(pipeline.backend_limits, "llm", BackendLimiter(8, math.inf))
+
+
+def model_stream(model, chunks):
+    """Return a stream function whose answers come from the named model."""
+    def stream(prompt, api_key):
+        result = ModelStream()
+        
+        def produce():
+            result.model = model
+            yield from chunks
+        
+        result._chunks = produce()
+        return result
+    return stream
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = tmp_path / "responses.sqlite3"
+    ResponseCache(path=path).put("prompt", "answer", model="gemini-2.5-flash")
+    
+    reopened = ResponseCache(path=path)
+    assert reopened.get_entry("prompt") == ("answer", "gemini-2.5-flash")
+    assert reopened.hits == 1
+    assert reopened.get("other") is None
+
+
+def test_memory_only_without_path(tmp_path):
+    ResponseCache().put("prompt", "answer")
+    assert ResponseCache().get("prompt") is None
+
+
+def test_expired_entries_are_dropped_from_disk(tmp_path):
+    path = tmp_path / "responses.sqlite3"
+    ResponseCache(path=path).put("prompt", "answer", ttl=0.05)
+    time.sleep(0.1)
+    cache = ResponseCache(path=path)
+    assert cache.get("prompt") is None
+    assert cache.evictions == 1
+
+
+def test_disk_rows_are_capped(tmp_path):
+    cache = ResponseCache(max_entries=1, path=tmp_path / "responses.sqlite3", max_disk_entries=2)
+    for i in range(4):
+        cache.put(f"prompt {i}", f"answer {i}")
+    reopened = ResponseCache(path=tmp_path / "responses.sqlite3")
+    assert [reopened.get(f"prompt {i}") for i in range(4)] == [None, None, "answer 2", "answer 3"]
+
+
+def test_streamed_answer_records_model(tmp_path):
+    cache = ResponseCache(path=tmp_path / "responses.sqlite3")
+    preferred = pipeline.model_router.models[0]
+    answer = "".join(ask_gemini_streaming("q", "key", stream=model_stream(preferred, ["a", "b"]), cache=cache))
+    assert answer == "ab"
+    assert cache.get_entry("q") == ("ab", preferred)
+    assert cache._entries[cache.key("q")][0] > pipeline.time.time() + pipeline.LLM_FALLBACK_CACHE_TTL
+
+
+def test_fallback_answers_expire_sooner(tmp_path):
+    cache = ResponseCache(path=tmp_path / "responses.sqlite3")
+    fallback = pipeline.model_router.models[-1]
+    "".join(ask_gemini_streaming("q", "key", stream=model_stream(fallback, ["x"]), cache=cache))
+    assert cache.get_entry("q") == ("x", fallback)
+    assert cache._entries[cache.key("q")][0] <= pipeline.time.time() + pipeline.LLM_FALLBACK_CACHE_TTL
+    
+    def failing(prompt, api_key):
+        raise RuntimeError("no stream")
+    
+    answer = "".join(ask_gemini_streaming("r", "key", stream=failing, cache=cache, ask=lambda p, k: "blocking"))
+    assert answer == "blocking"
+    assert cache.get_entry("r") == ("blocking", pipeline.BLOCKING_MODEL)
@@ -0,0 +1,48 @@
+"""Hybrid retrieval over a small in-memory knowledge base."""
+from types import SimpleNamespace
+
+import numpy as np
+
+from pipeline import FieldBM25Index, hybrid_retrieve, retrieve_batch
+
+
+def entry(verse_id, meaning, tags=(), keywords=()):
+    return SimpleNamespace(id=verse_id, meaning_simple_en=meaning, meaning_detailed_en=meaning,
+                           tags=list(tags), keywords=list(keywords))
+
+
+ENTRIES = [
+    entry("v1", "Bringing the life-saving herb, you revived Lakshmana.", ["sanjeevani", "healing"]),
+    entry("v2", "You leapt across the ocean with Rama's ring.", ["ocean_crossing"], ["ring"]),
+    entry("v3", "As a child you swallowed the sun, thinking it a fruit.", ["childhood"]),
+    entry("v4", "Chanting your name removes disease and suffering.", ["healing", "chanting"]),
+]
+QUERIES = ["herb that revived Lakshmana", "crossing the ocean", "healing", "sun fruit", "nothing matches zzz"]
+
+
+def test_finds_the_labelled_verse():
+    index = FieldBM25Index(ENTRIES)
+    assert hybrid_retrieve("herb that revived Lakshmana", index, top_k=1)[0][0].id == "v1"
+    assert hybrid_retrieve("ring over the ocean", index, top_k=1)[0][0].id == "v2"
+    assert {e.id for e, _ in hybrid_retrieve("healing", index, top_k=2)} == {"v1", "v4"}
+
+
+def test_no_match_returns_nothing():
+    assert hybrid_retrieve("nothing matches zzz", FieldBM25Index(ENTRIES)) == []
+
+
+def test_batch_matches_single_queries():
+    index = FieldBM25Index(ENTRIES)
+    batch = retrieve_batch(QUERIES, index, top_k=3)
+    assert len(batch) == len(QUERIES)
+    for query, results in zip(QUERIES, batch):
+        single = hybrid_retrieve(query, index, top_k=3)
+        assert [e.id for e, _ in results] == [e.id for e, _ in single]
+        np.testing.assert_allclose([s for _, s in results], [s for _, s in single])
+    assert retrieve_batch([], index) == []
+
+
+def test_batch_scores_match_single_scores():
+    index = FieldBM25Index(ENTRIES)
+    np.testing.assert_allclose(index.score_batch(QUERIES), [index.score(query) for query in QUERIES])
+    np.testing.assert_allclose(index.cosine_batch(QUERIES), [index.cosine(query) for query in QUERIES])
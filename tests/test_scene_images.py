@@ -0,0 +1,105 @@
+"""Concurrent scene image generation: ordering, retries, per-scene timeouts and slot limits."""
+import math
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import pipeline
+from pipeline import BackendLimiter, generate_scene_images
+
+
+@pytest.fixture(autouse=True)
+def fast_backend(monkeypatch):
+    monkeypatch.setitem(pipeline.backend_limits, "image", BackendLimiter(8, math.inf))
+    monkeypatch.setattr(pipeline, "SCENE_BACKOFF", 0.0)
+
+
+def image():
+    return Image.new("RGB", (8, 8))
+
+
+def scripted(delays):
+    """Return a generate() that sleeps delays[prompt] seconds before returning an image."""
+    def generate(prompt, method="pollinations"):
+        time.sleep(delays[prompt])
+        return image()
+    return generate
+
+
+def test_scenes_are_yielded_in_completion_order():
+    generate = scripted({"a": 0.3, "b": 0.0, "c": 0.15})
+    results = list(generate_scene_images(["a", "b", "c"], max_workers=3, generate=generate))
+    assert [i for i, _, _ in results] == [2, 3, 1]
+    assert all(img is not None and error is None for _, img, error in results)
+
+
+def test_failed_call_is_retried():
+    calls = []
+    
+    def flaky(prompt, method="pollinations"):
+        calls.append(prompt)
+        if len(calls) == 1:
+            raise RuntimeError("503")
+        return image()
+    
+    [(i, img, error)] = generate_scene_images(["a"], generate=flaky)
+    assert (i, error) == (1, None) and img is not None
+    assert calls == ["a", "a"]
+
+
+def test_persistent_failure_is_reported():
+    def broken(prompt, method="pollinations"):
+        raise RuntimeError("503")
+    
+    [(i, img, error)] = generate_scene_images(["a"], generate=broken)
+    assert img is None and str(error) == "503"
+
+
+def test_slow_scene_times_out_without_holding_back_others():
+    generate = scripted({"a": 0.0, "hang": 2.0, "c": 0.0})
+    start = time.perf_counter()
+    results = {i: (img, error) for i, img, error in
+               generate_scene_images(["a", "hang", "c"], max_workers=3, timeout=0.3, generate=generate)}
+    assert time.perf_counter() - start < 1.0
+    assert results[1][0] is not None and results[3][0] is not None
+    assert results[2][0] is None and isinstance(results[2][1], TimeoutError)
+
+
+def test_deadline_starts_when_each_scene_is_submitted():
+    def planned():
+        # Planning takes longer than the per-scene timeout; later scenes still get their full budget
+        yield "a"
+        time.sleep(0.4)
+        yield "b"
+    
+    generate = scripted({"a": 0.5, "b": 0.2})
+    results = {i: (img, error) for i, img, error in
+               generate_scene_images(planned(), max_workers=2, timeout=0.3, generate=generate)}
+    assert isinstance(results[1][1], TimeoutError)
+    assert results[2][0] is not None
+
+
+def test_slot_wait_times_out():
+    limiter = BackendLimiter(1, math.inf, timeout=0.1)
+    held = threading.Event()
+    release = threading.Event()
+    
+    def hold():
+        with limiter:
+            held.set()
+            release.wait()
+    
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    with pytest.raises(TimeoutError):
+        with limiter:
+            pass
+    release.set()
+    thread.join()
+    # The failed wait left no slot or nesting state behind
+    with limiter:
+        pass
+    assert limiter.calls == 2